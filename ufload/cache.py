@@ -0,0 +1,88 @@
+# Local cache of the downloaded backups.
+#
+# A backup is stored under a key made of its ServerRelativeUrl,
+# TimeLastModified and Length, so a file changed on the cloud is never
+# served from the cache. The least recently used backups are removed
+# when the cache grows over its budget.
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+import zipfile
+
+import ufload
+
+def key(url, modified, size):
+    return hashlib.sha1('%s|%s|%d' % (url, modified, size)).hexdigest()
+
+# Hard link when we can (same disk, not Windows), copy otherwise
+def _link(src, dst):
+    if os.path.exists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):
+        shutil.copyfile(src, dst)
+
+class BackupCache(object):
+    def __init__(self, path, budget):
+        self.path = path
+        self.budget = budget
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, k):
+        return os.path.join(self.path, k + '.zip')
+
+    # Puts the cached backup at filename and returns True, or returns
+    # False if it is not in the cache (or is damaged, then it is removed).
+    def get(self, k, size, filename):
+        fn = self._file(k)
+        with self.lock:
+            if not os.path.exists(fn):
+                return False
+            if os.path.getsize(fn) != size or not zipfile.is_zipfile(fn):
+                ufload.progress("Cached backup %s is damaged, removing it" % fn)
+                os.unlink(fn)
+                return False
+            now = time.time()
+            os.utime(fn, (now, now))
+            _link(fn, filename)
+        return True
+
+    def put(self, k, filename):
+        with self.lock:
+            try:
+                _link(filename, self._file(k))
+            except (IOError, OSError) as e:
+                ufload.progress("Unable to cache %s: %s" % (filename, e))
+                return
+            self._evict()
+
+    # Removes a backup found damaged after get() let it through
+    def drop(self, k):
+        fn = self._file(k)
+        with self.lock:
+            if os.path.exists(fn):
+                ufload.progress("Removing damaged %s from the backup cache" % fn)
+                os.unlink(fn)
+
+    # Removes the least recently used backups until the cache fits in its budget
+    def _evict(self):
+        entries = []
+        for n in os.listdir(self.path):
+            fn = os.path.join(self.path, n)
+            st = os.stat(fn)
+            entries.append((st.st_mtime, st.st_size, fn))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        # the newest entry is always kept, even if it alone is over budget
+        for mtime, size, fn in entries[:-1]:
+            if total <= self.budget:
+                break
+            ufload.progress("Removing %s from the backup cache" % fn)
+            os.unlink(fn)
+            total -= size
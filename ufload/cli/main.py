@@ -3,9 +3,13 @@ import requests
 import requests.auth
 import subprocess
 import shutil
+import copy
+import threading
+import Queue
 import time
 import re
 import socket
+import zipfile
 
 import ufload
 
@@ -23,7 +27,7 @@ def _progress(p):
     print >> sys.stderr, p
     _logs.append(p)
 
-    if args.local:
+    if getattr(args, 'local', None):
         #Create directory if necessary
         try:
             os.stat(args.local)
@@ -171,42 +175,252 @@ def _fileRestore(args):
     else:
         return rc, None
 
+# Restore one file of the -dir directory. Returns the name of the database.
+def _restoreDirFile(args, item):
+    sz, file = item
+    db = _file_to_db(args, file)
+    fullfile = '%s/%s' % (args.dir, file)
+    if db is None:
+        ufload.progress("Could not set the instance from the file %s." % file)
+
+    with open(fullfile, 'rb') as f:
+        ufload.db.load_dump_into(args, db, f, sz)
+
+    if not args.noclean:
+        ufload.db.clean(args, db)
+
+    if args.notify:
+        subprocess.call([args.notify, db])
+
+    return db
+
 def _dirRestore(args):
     files = os.listdir(args.dir)
-    dbs = []
-    atleastone = False
 
+    sizes = []
     for file in files:
-        db = _file_to_db(args, file)
-        fullfile = '%s/%s' % (args.dir, file)
-        if db is None:
-            ufload.progress("Could not set the instance from the file %s." % file)
-        else:
-            dbs.append(db)
-            atleastone = True
-
         try:
-            statinfo = os.stat(fullfile)
-            sz = statinfo.st_size
+            sizes.append((os.path.getsize('%s/%s' % (args.dir, file)), file))
         except OSError as e:
             ufload.progress("Could not find file size: " + str(e))
-            sz = 0
             return 1, None
 
-        with open(fullfile, 'rb') as f:
-            ufload.db.load_dump_into(args, db, f, sz)
-
-        if not args.noclean:
-            ufload.db.clean(args, db)
-
-        if args.notify:
-            subprocess.call([args.notify, db])
+    if args.parallel > 1:
+        dbs = _runParallel(args, [ (x[0], x) for x in sizes ], _restoreDirFile)
+    else:
+        dbs = [ _restoreDirFile(args, x) for x in sizes ]
+    dbs = filter(None, dbs)
 
-    if atleastone:
+    if dbs:
         return 0, dbs
     else:
         return 2, None
 
+# Runs fn(args, item) for the (size, item) tuples, largest first, in
+# -parallel threads. The -jobs budget is split between the concurrent
+# restores. A failing item is logged and does not stop the others.
+# Returns the results of fn, in the order they finished.
+def _runParallel(args, items, fn):
+    items = sorted(items, key=lambda x: x[0], reverse=True)
+    n = max(1, min(args.parallel, len(items)))
+
+    wargs = copy.copy(args)
+    if args.jobs == 'auto':
+        ufload.progress("Running %d restores at once, with pg_restore jobs picked for each" % n)
+    elif args.jobs:
+        wargs.jobs = max(1, args.jobs / n)
+        ufload.progress("Running %d restores at once, with %d pg_restore jobs each" % (n, wargs.jobs))
+    else:
+        ufload.progress("Running %d restores at once" % n)
+
+    q = Queue.Queue()
+    for sz, item in items:
+        q.put(item)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                item = q.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                res = fn(wargs, item)
+            except Exception as e:
+                ufload.progress("Unexpected error while restoring %s: %s" % (item, e))
+                continue
+            with lock:
+                results.append(res)
+
+    threads = [ threading.Thread(target=worker, name='ufload-restore-%d' % x) for x in range(n) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+# -jobs is a number or auto
+def _jobsArg(v):
+    if v == 'auto':
+        return v
+    try:
+        return int(v)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a number nor auto" % v)
+
+# UniField auto-upload filename pattern
+_backupPattern = re.compile('.*-[A-Z]{1}[a-z]{2}\.zip$')
+
+# If -oc is not known, change the connection settings according to the instance
+def _changeOc(dav, baseurl, i):
+    if i.endswith('_OCA'):
+        dav.change_oc(baseurl, 'OCA')
+    elif i.startswith('OCB'):
+        dav.change_oc(baseurl, 'OCB')
+    elif i.startswith('OCG_'):
+        dav.change_oc(baseurl, 'OCG')
+    elif i.startswith('OCP_'):
+        dav.change_oc(baseurl, 'OCP')
+
+# Download the backup j, unless reading its zip directory in the cloud
+# shows that its database already exists: then returns None.
+def _fetch(args, dav, j):
+    n = ufload.cloud.peek_inside_remote_file(dav, j[0], j[2] or -1)
+    if n is not None:
+        db = _file_to_db(args, str(n))
+        if db is not None and ufload.db.exists(args, db):
+            ufload.progress("Database %s already exists." % db)
+            return None
+    return dav.download(j[0], j[1], j[3], j[2])
+
+# Restore the backup j straight from the cloud (-stream): it is inflated
+# and fed to pg_restore while being downloaded. Returns (rc, db), db
+# being None when the database already exists. rc is None when the
+# backup could not be streamed, and has to be downloaded instead.
+def _streamBackup(args, dav, j):
+    n = ufload.cloud.peek_inside_remote_file(dav, j[0], j[2] or -1)
+    if n is None:
+        return None, None
+    db = _file_to_db(args, str(n))
+    if db is None:
+        return None, None
+    if ufload.db.exists(args, db):
+        ufload.progress("Database %s already exists." % db)
+        return 0, None
+    ufload.progress("Database %s does not exist, streaming it from the cloud." % db)
+
+    try:
+        zs = ufload.cloud.ZipStream(dav.stream(j[0])).start()
+    except Exception as e:
+        ufload.progress("Unable to stream %s: %s" % (j[1], e))
+        return None, None
+    try:
+        rc = ufload.db.load_stream_into(args, db, zs, zs.size)
+    finally:
+        zs.close()
+
+    if rc != 0 and zs.error is not None:
+        ufload.progress("Streaming of %s failed (%s), downloading it instead." % (j[1], zs.error))
+        return None, None
+    return rc, db
+
+# Post-restore steps of a database
+def _restored(args, db):
+    if not args.noclean:
+        ufload.db.clean(args, db)
+
+    if args.notify:
+        subprocess.call([ args.notify, db ])
+    return db
+
+# Restore the newest usable backup of instance i. The first candidate
+# comes from the prefetcher when there is one. Returns the name of the
+# restored database, or None.
+def _restoreInstance(args, dav, baseurl, i, files_for_instance, prefetch=None):
+    first = True
+    for j in files_for_instance:
+
+        #If filename doesn't match UniField auto-upload filename pattern, go to next file
+        if not _backupPattern.match(j[1]):
+            continue
+
+        ufload.progress("Trying file %s" % j[1])
+        if not args.oc:
+            _changeOc(dav, baseurl, i)
+
+        if args.stream:
+            rc, db = _streamBackup(args, dav, j)
+            if rc == 0:
+                if db is None:
+                    return None
+                return _restored(args, db)
+            if rc is not None:
+                # the backup is bad, try the next one
+                continue
+
+        try:
+            if first and prefetch is not None:
+                filename = prefetch.get(i)
+            else:
+                filename = _fetch(args, dav, j)
+        except Exception, e:
+            ufload.progress("Error upload %s" % e)
+            continue
+        finally:
+            first = False
+
+        if filename is None:
+            # the database of this backup is already there
+            return None
+
+        filesize = os.path.getsize(filename) / (1024 * 1024)
+        ufload.progress("File size: %s Mb" % filesize)
+
+        try:
+            dz = ufload.cloud.DumpZip(filename)
+        except Exception as e:
+            ufload.progress("Zipfile %s cannot be used: %s" % (filename, e))
+            os.unlink(filename)
+            dav.uncache(j[0], j[3], j[2])
+            # try the next one
+            continue
+
+        db = _file_to_db(args, str(dz.name))
+        if db is None:
+            ufload.progress("Bad filename %s. Skipping." % dz.name)
+            dz.close()
+            os.unlink(filename)
+            continue
+
+        if ufload.db.exists(args, db):
+            ufload.progress("Database %s already exists." % db)
+            dz.close()
+            os.unlink(filename)
+            return None
+        else:
+            ufload.progress("Database %s does not exist, restoring." % db)
+
+        try:
+            rc = ufload.db.load_zip_into(args, db, dz, dz.size)
+        except zipfile.BadZipfile as e:
+            # bad CRC: the dump was damaged after all
+            ufload.progress("Zipfile %s cannot be used: %s" % (filename, e))
+            dav.uncache(j[0], j[3], j[2])
+            continue
+        finally:
+            dz.close()
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+
+        if rc == 0:
+            # We got a good load, so go to the next instance.
+            return _restored(args, db)
+
+    return None
+
 def _multiRestore(args):
     if not _required(args, [ 'user', 'pw' ]):
         ufload.progress('With no -file or -dir argument, cloud credentials are mandatory.')
@@ -222,6 +436,10 @@ def _multiRestore(args):
             ufload.progress('Argument -oc not provided, please note that ufload will look for a OC pattern in the -i arguments (you might want to avoid partial substrings)')
         ufload.progress("Multiple Instance restore for instances matching: %s" % " or ".join(args.i))
 
+    # relative to where ufload was started, not to the working directory
+    if args.cache_dir:
+        args.cache_dir = os.path.abspath(args.cache_dir)
+
     if args.workingdir:
         try:
             os.mkdir(args.workingdir)
@@ -242,27 +460,36 @@ def _multiRestore(args):
     ufload.progress('site=%s - path=%s - dir=%s' % (info.get('site'), info.get('path'), info.get('dir')))
     dav = ufload.cloud.get_onedrive_connection(args)
 
+    baseurl = dav.baseurl.rstrip('/')
     if not args.oc:
         #foreach -i add the dir
         dirs = []
         instances = {}
-        baseurl = dav.baseurl.rstrip('/')
         for substr in args.i:
             if args.exclude is None or not ufload.cloud._match_instance_name(args.exclude, substr):
                 dirs.append(ufload.cloud.instance_to_dir(substr))
         #Remove duplicates
         dirs = list(set(dirs))
-        #Get the list for every required OC
+        #Get the list for every required OC, all at once, each with its own client
+        found = {}
+        def list_oc(dir):
+            odav = dav.clone()
+            odav.change_oc(baseurl, dir)
+            found[dir] = ufload.cloud.list_files(user=info.get('login'),
+                                                 pw=info.get('password'),
+                                                 where=dir + args.cloud_path,
+                                                 instances=args.i,
+                                                 dav=odav,
+                                                 url=info.get('url'),
+                                                 site=dir,
+                                                 path=info.get('path'))
+        threads = [ threading.Thread(target=list_oc, args=(dir,)) for dir in dirs ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
         for dir in dirs:
-            dav.change_oc(baseurl, dir)
-            instances.update(ufload.cloud.list_files(user=info.get('login'),
-                                                     pw=info.get('password'),
-                                                     where=dir + args.cloud_path,
-                                                     instances=args.i,
-                                                     dav=dav,
-                                                     url=info.get('url'),
-                                                     site=dir,
-                                                     path=info.get('path')))
+            instances.update(found.get(dir, {}))
     else:
         instances = ufload.cloud.list_files(user=info.get('login'),
                                             pw=info.get('password'),
@@ -283,92 +510,49 @@ def _multiRestore(args):
 
     ufload.progress("Instances to be restored: %s" % ", ".join(instances.keys()))
     dbs=[]
-    pattern = re.compile('.*-[A-Z]{1}[a-z]{2}\.zip$')
 
+    # Work on the biggest instances first, so that a parallel run
+    # does not end with one big restore alone
+    order = []
     for i in instances:
-
-        files_for_instance = instances[i]
-        for j in files_for_instance:
-
-            #If filename doesn't match UniField auto-upload filename pattern, go to next file
-            if not pattern.match(j[1]):
-                continue
-
-            ufload.progress("Trying file %s" % j[1])
-            #If -oc is not known, change the connection settings according to the current instance
-            if not args.oc:
-                if i.endswith('_OCA'):
-                    dav.change_oc(baseurl, 'OCA')
-                elif i.startswith('OCB'):
-                    dav.change_oc(baseurl, 'OCB')
-                elif i.startswith('OCG_'):
-                    dav.change_oc(baseurl, 'OCG')
-                elif i.startswith('OCP_'):
-                    dav.change_oc(baseurl, 'OCP')
-
-            try:
-                filename = dav.download(j[0],j[1])
-            except Exception, e:
-                ufload.progress("Error upload %s" % e)
-                continue
-
-            filesize = os.path.getsize(filename) / (1024 * 1024)
-            ufload.progress("File size: %s Mb" % filesize)
-
-            n= ufload.cloud.peek_inside_local_file(j[0], filename)
-            if n is None:
-                os.unlink(j[1])
-                # no dump inside of zip, try the next one
-                continue
-
-            db = _file_to_db(args, str(n))
-            if ufload.db.exists(args, db):
-                ufload.progress("Database %s already exists." % db)
-                os.unlink(j[1])
+        for j in instances[i]:
+            if _backupPattern.match(j[1]):
+                order.append((j[2], i, j))
                 break
-            else:
-                ufload.progress("Database %s does not exist, restoring." % db)
-
-            '''f, sz = ufload.cloud.openDumpInZip(j[0], j[1],
-                                           user=args.user,
-                                           pw=args.pw,
-                                           where=_ocToDir(args.oc))
-            '''
-            fname, sz = ufload.cloud.openDumpInZip(j[1])
-            if fname is None:
-                os.unlink(j[1])
-                continue
-
-            db = _file_to_db(args, fname)
-            if db is None:
-                ufload.progress("Bad filename %s. Skipping." % fname)
-                try:
-                    os.unlink(j[1])
-                except:
-                    pass
-                continue
-
-            rc = ufload.db.load_zip_into(args, db, j[1], sz)
-            if rc == 0:
-                dbs.append(db)
-
-                if not args.noclean:
-                    rc = ufload.db.clean(args, db)
-
-                if args.notify:
-                    subprocess.call([ args.notify, db ])
-
-                try:
-                    os.unlink(j[1])
-                except:
-                    pass
+    if args.parallel > 1:
+        order.sort(key=lambda x: x[0], reverse=True)
+
+    if args.stream and (ufload.db.needs_file(args) or args.slim):
+        # pg_restore has to read the dump from a file then
+        ufload.progress("-stream cannot be used with -jobs, -sections, -slim or on Windows, downloading the backups.")
+        args.stream = False
+
+    prefetch = None
+    if args.prefetch and not args.stream:
+        # Download the newest backup of the next instances while the
+        # current one is being restored
+        jobs = [ (i, j) for sz, i, j in order ]
+        pdav = dav.clone()
+        def fetch(i, j):
+            if not args.oc:
+                _changeOc(pdav, baseurl, i)
+            return _fetch(args, pdav, j)
+        prefetch = ufload.cloud.Prefetcher(fetch, jobs, args.prefetch,
+                                           (args.prefetch_mb or 0) * 1024 * 1024).start()
 
-                # We got a good load, so go to the next instance.
-                break
-            try:
-                os.unlink(j[1])
-            except Exception:
-                pass
+    try:
+        if args.parallel > 1:
+            def restore(wargs, i):
+                return _restoreInstance(wargs, dav.clone(), baseurl, i, instances[i], prefetch)
+            dbs = filter(None, _runParallel(args, [ (sz, i) for sz, i, j in order ], restore))
+        else:
+            for i in instances:
+                db = _restoreInstance(args, dav, baseurl, i, instances[i], prefetch)
+                if db is not None:
+                    dbs.append(db)
+    finally:
+        if prefetch is not None:
+            prefetch.close()
 
     if args.ss and not args.nologin:
         # connect to trigger update if needed
@@ -463,12 +647,16 @@ def _syncLink(args, dbs, sdb):
 
     if args.ss and (args.sync is None and args.synclight is None):
         #We don't update hardware id for all local instances: instances from another server could be already connected
+        names = []
         for db in dbs:
             instance = ufload.db._db_to_instance(args, db)
             if not db:
                 instance = db
-            ufload.progress("Updating hardware id and entity name for %s in sync server" % db)
-            ufload.db.psql(args, "update sync_server_entity set hardware_id = '%s' where name='%s';" % (hwid, instance), sdb)
+            names.append(instance)
+        ufload.progress("Updating hardware id and entity name for %s in sync server" % ', '.join(dbs))
+        plan = ufload.db.Plan()
+        plan.add('hardware id', "update sync_server_entity set hardware_id = %(hwid)s where name = any(%(names)s)", hwid=hwid, names=names)
+        ufload.db.run_plan(args, plan, sdb)
 
     else:
         # We update hardware id for all local instances: it's a new sync server, so no instance is connected yet
@@ -494,7 +682,8 @@ def _cmdLs(args):
                                         dav=dav,
                                         url=info.get('url'),
                                         site=info.get('site'),
-                                        path=info.get('path'))
+                                        path=info.get('path'),
+                                        latest=True)
 
     if len(instances) == 0:
         ufload.progress("No files found.")
@@ -744,18 +933,23 @@ def _cmdUpgrade(args):
                 ufload.db.manual_sync(args, ss, instance)
 
     if (args.autosync or  args.silentupgrade) and update_src:
+        instances = [ i for i in instances if i ]
         for instance in instances:
-            if instance:
-                ufload._progress("Connecting instance %s to sync server %s" % (instance, ss))
-                ufload.db.connect_instance_to_sync_server(args, ss, instance)
-                #ufload._progress("Update instance %s" % instance)
-                #ufload.db.updateInstance(instance)
-                if args.autosync:
-                    #activate auto-sync (now + 1 hour)
-                    ufload.db.activate_autosync(args, instance, ss)
-                if args.silentupgrade:
-                    #activate silent upgrade
-                    ufload.db.activate_silentupgrade(args, instance)
+            ufload._progress("Connecting instance %s to sync server %s" % (instance, ss))
+            ufload.db.connect_instance_to_sync_server(args, ss, instance)
+            #ufload._progress("Update instance %s" % instance)
+            #ufload.db.updateInstance(instance)
+
+        plan = ufload.db.Plan()
+        if args.autosync:
+            #activate auto-sync (now + 1 hour)
+            ufload.db.autosync_steps(plan, ss)
+        if args.silentupgrade:
+            #activate silent upgrade
+            if not args.autosync:
+                ufload.progress("*** WARNING: Silent upgrade is enabled, but auto sync is not.")
+            ufload.db.silentupgrade_steps(plan)
+        ufload.db.fanout(args, plan, instances)
 
     ufload.progress(" *** summarize ***" )
     ufload.progress(" * Initial version installed: {}".format(summarize['initial_version']) )
@@ -793,6 +987,10 @@ def parse():
     parser.add_argument("-killconn", help="The command to run kill connections to the databases.")
     parser.add_argument("-remote", help="Remote log server")
     parser.add_argument("-local-log", dest='local', help="Path to create a local log file")
+    parser.add_argument("-segments", dest='segments', type=int, help="number of parallel connections used to download a backup (default = 4, 1 to disable)")
+    parser.add_argument("-auth-cache", dest='auth_cache', help="file keeping the OneDrive session between runs (default = $HOME/.ufload-auth, empty to disable)")
+    parser.add_argument("-index", dest='index', help="file keeping an index of the OneDrive backups, listed incrementally; deleted backups are only noticed once a day (optional)")
+    parser.add_argument("-db-workers", dest='db_workers', type=int, default=8, help="number of databases updated at once (default = 8)")
     parser.add_argument("-n", dest='show', action='store_true', help="no real work; only show what would happen")
 
     sub = parser.add_subparsers(title='subcommands',
@@ -833,8 +1031,19 @@ def parse():
     pRestore.add_argument("-connectionpw", default='Only4Sandbox', help="Password to connect instance to the sync server")
     pRestore.add_argument("-logo", dest='logo', help="path to the new company logo")
     pRestore.add_argument("-banner", dest='banner', help="text to display in the banner")
-    pRestore.add_argument("-jobs", dest='jobs', type=int, help="Number of concurrent pg_restore jobs")
+    pRestore.add_argument("-jobs", dest='jobs', type=_jobsArg, help="Number of concurrent pg_restore jobs, or auto to pick it from the dump and the resources")
+    pRestore.add_argument("-sections", action='store_true', help="restore the schema, the data (with bulk load settings) and the indexes and constraints one after the other, showing the time of each")
+    pRestore.add_argument("-slim", action='store_true', help="do not restore the data of the -slim-tables (the tables are created empty)")
+    pRestore.add_argument("-slim-tables", dest='slim_tables', help="comma separated tables (* and ? allowed) left empty by -slim (default = %s)" % ufload.db.slim_tables)
+    pRestore.add_argument("-post-jobs", dest='post_jobs', type=int, help="with -sections, number of concurrent jobs building the indexes and constraints (default = -jobs)")
+    pRestore.add_argument("-maintenance-mb", dest='maintenance_mb', type=int, help="with -sections, memory in Mb shared by the jobs building the indexes and constraints (default = %d)" % ufload.db.maintenance_mb)
     pRestore.add_argument("-no-login", dest='nologin', action='store_true', help="do not login to the instances, do not trigger upgrade")
+    pRestore.add_argument("-cache-dir", dest='cache_dir', help="keep the downloaded backups in this directory to restore them again without downloading (optional)")
+    pRestore.add_argument("-cache-mb", dest='cache_mb', type=int, default=20480, help="disk budget in Mb of -cache-dir, the least recently used backups are removed first (default = 20480)")
+    pRestore.add_argument("-parallel", dest='parallel', type=int, default=1, help="number of instances restored at once, biggest first (the -jobs are shared between them)")
+    pRestore.add_argument("-prefetch", dest='prefetch', type=int, default=0, help="number of backups to download ahead while restoring (default = 0, no prefetch)")
+    pRestore.add_argument("-prefetch-mb", dest='prefetch_mb', type=int, default=0, help="disk budget in Mb for the prefetched backups (default = 0, no limit)")
+    pRestore.add_argument("-stream", action='store_true', help="restore the backups while they are downloaded, without writing them to disk")
     pRestore.set_defaults(func=_cmdRestore)
 
     pArchive = sub.add_parser('archive', help="Copy new data into the database.")
@@ -905,4 +1114,5 @@ def main():
 
     sys.exit(rc)
 
-main()
+if __name__ == '__main__':
+    main()
@@ -12,3 +12,50 @@ def test_file_to_db():
     assert(i is None)
 
 
+
+class ArgRestore:
+    def __init__(self):
+        self.oc = 'OCG'
+        self.stream = False
+        self.nosuffix = False
+        self.db_prefix = None
+        self.db_tablespace = None
+        self.db_user = 'openpg'
+        self.show = False
+        self.jobs = None
+        self.sections = False
+        self.slim = False
+
+def test_damaged_cached_backup(tmpdir, monkeypatch):
+    import os, zipfile
+    import ufload.cache, ufload.webdav
+    fn = str(tmpdir.join('OCG_HQ-Mon.zip'))
+    z = zipfile.ZipFile(fn, 'w', zipfile.ZIP_STORED)
+    z.writestr('OCG_HQ-20200106-010000-A-UF.dump', 'dump' * 100000)
+    z.close()
+    # flip a byte of the dump: the zip directory is fine, the CRC is not
+    data = bytearray(open(fn, 'rb').read())
+    data[-1000] ^= 0xff
+    open(fn, 'wb').write(data)
+
+    dav = ufload.webdav.Client.__new__(ufload.webdav.Client)
+    dav.cache = ufload.cache.BackupCache(str(tmpdir.join('cache')), 1 << 30)
+    j = ('/a/OCG_HQ-Mon.zip', 'OCG_HQ-Mon.zip', len(data), '2020-01-06T01:00:00Z')
+    k = ufload.cache.key(j[0], j[3], j[2])
+    dav.cache.put(k, fn)
+
+    class Prefetch:
+        def get(self, i):
+            assert dav.cache.get(k, j[2], fn)
+            return fn
+
+    sqls = []
+    monkeypatch.setattr(ufload, 'progress', lambda p: None)
+    monkeypatch.setattr(ufload.db, 'psql', lambda args, sql, db='postgres', silent=False: sqls.append(sql) or 0)
+    monkeypatch.setattr(ufload.db, 'killCons', lambda args, db: None)
+    monkeypatch.setattr(ufload.db, 'exists', lambda args, db: False)
+    monkeypatch.setattr(ufload.db, 'pg_restore', lambda args: [ 'pg_restore' ])
+    monkeypatch.setattr(ufload.db, '_pipe_restore', lambda args, cmd, f, sz: len(f.read()) and 0)
+    assert ufload.cli.main._restoreInstance(ArgRestore(), dav, None, 'OCG_HQ', [ j ], Prefetch()) is None
+    assert os.listdir(dav.cache.path) == []
+    assert sqls[-1].startswith('DROP DATABASE')
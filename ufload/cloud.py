@@ -1,12 +1,20 @@
 # Routines related to ownCloud
 
+import os
 import time
 import zipfile
 import collections
 import logging
 import base64
 import sys
+import shutil
+import threading
+import Queue
+import struct
+import zlib
 import webdav
+import index
+import cache
 from urlparse import urlparse
 
 
@@ -96,22 +104,44 @@ def get_onedrive_connection(args):
     path = info.get('site') + url.path
 
     try:
+        segments = getattr(args, 'segments', None)
+        if segments is not None:
+            segments = int(segments)
         dav = webdav.Client(url.netloc, port=url.port, protocol=url.scheme, username=info['login'],
-                            password=info['password'], path=path)
-        return dav
+                            password=info['password'], path=path, segments=segments,
+                            auth_cache=getattr(args, 'auth_cache', None))
     except webdav.ConnectionFailed, e:
         ufload.progress('Unable to connect: {}'.format(e))
         ufload.progress('Cannot proceed without connection, exiting program.')
         exit(1)
 
+    # Downloaded backups are kept in -cache-dir, within -cache-mb
+    if getattr(args, 'cache_dir', None):
+        mb = int(getattr(args, 'cache_mb', None) or 20480)
+        dav.cache = cache.BackupCache(args.cache_dir, mb * 1024 * 1024)
 
+    # Listings are answered from the local index given with -index
+    path = getattr(args, 'index', None)
+    if path:
+        try:
+            dav.index = index.Index(path)
+        except Exception as e:
+            ufload.progress('Unable to open the index %s: %s' % (path, e))
+    return dav
 
 
-def _get_all_files_and_timestamp(dav, d):
+
+
+# With full, the index (if any) is completely refreshed first, so that
+# no deleted file is returned.
+def _get_all_files_and_timestamp(dav, d, patterns=None, full=False):
     ufload.progress('Browsing files from dir %s' % d)
     try:
         #all_zip = dav.ls(d)
-        all_zip = dav.list(d)
+        if getattr(dav, 'index', None) is not None:
+            all_zip = dav.index.list(dav, d, full)
+        else:
+            all_zip = dav.list(d, patterns)
     except Exception as e:
         ufload.progress("Cloud Exception 88")
         logging.warn(str(e))
@@ -119,25 +149,26 @@ def _get_all_files_and_timestamp(dav, d):
 
     ret = []
     for f in all_zip:
-        #if not f['Name'] or f['Name'][-1] == '/':
-        if not f['Name']:
+        #if not f.name or f.name[-1] == '/':
+        if not f.name:
+            continue
+
+        if f.name.split(".")[-1] != "zip":
+            logging.warn("Ignoring non-zipfile: %s" % f.name)
             continue
 
         # We try to extract a timestamp to get an idea of the creation date
-        #  Format: Mon, 14 Mar 2016 03:31:40 GMT
-        t = time.strptime(f['TimeLastModified'], '%Y-%m-%dT%H:%M:%SZ')
+        #  Format: 2016-03-14T03:31:40Z
+        t = time.strptime(f.modified, '%Y-%m-%dT%H:%M:%SZ')
 
         # We don't take into consideration backups that are too recent.
         # Otherwise they could be half uploaded (=> corrupted)
         if abs(time.time() - time.mktime(t)) < 900:
             continue
 
-        # ufload.progress('File found: %s' % f['Name'])
+        # ufload.progress('File found: %s' % f.name)
 
-        if f['Name'].split(".")[-1] != "zip":
-            logging.warn("Ignoring non-zipfile: %s" % f['Name'])
-            continue
-        ret.append((t, f['Name'], f['ServerRelativeUrl']))
+        ret.append((t, f.name, f.url, f.size, f.modified))
     return ret
 
 # returns True if x has instance as a substring
@@ -164,7 +195,7 @@ def _group_files_to_download(files):
     ret = collections.defaultdict(lambda : [])
 
     for a in files:
-        t, f, u = a
+        t, f, u, sz, m = a
         #if '/' not in f:
         #   raise Exception("no slash in %s" % f)
 
@@ -175,18 +206,22 @@ def _group_files_to_download(files):
             continue
 
         instance = '-'.join(f.split('-')[:-1])
-        ret[instance].append((u, f))
+        ret[instance].append((u, f, sz, m))
 
     return ret
 
 # list_files returns a dictionary of instances
-# and for each instance, a list of (path,file) tuples
-# in order from new to old.
+# and for each instance, a list of (path,file,size,modified) tuples
+# in order from new to old (only the newest one with latest=True).
 def list_files(**kwargs):
     directory = kwargs['where']
 
+    dav = kwargs['dav']
+    if getattr(dav, 'index', None) is not None:
+        return _list_indexed_files(dav, directory, kwargs['instances'], kwargs.get('latest', False))
+
     #all = _get_all_files_and_timestamp(dav, "/remote.php/webdav/"+directory)
-    all = _get_all_files_and_timestamp(kwargs['dav'], directory)
+    all = _get_all_files_and_timestamp(kwargs['dav'], directory, kwargs['instances'])
 
     all = _group_files_to_download(all)
 
@@ -200,25 +235,49 @@ def list_files(**kwargs):
             ret[i] = all[i]
     return ret
 
+# Same as list_files, answered by the index of dav
+def _list_indexed_files(dav, d, instances, latest):
+    ufload.progress('Browsing files from dir %s' % d)
+    # We don't take into consideration backups that are too recent.
+    # Otherwise they could be half uploaded (=> corrupted)
+    before = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - 900))
+    try:
+        found = dav.index.instances(dav, d, instances, before, latest)
+    except Exception as e:
+        ufload.progress("Cloud Exception 88")
+        logging.warn(str(e))
+        return {}
+
+    ret = {}
+    for i, files in found.items():
+        ret[i] = [ (f.url, f.name, f.size, f.modified) for f in files ]
+    return ret
+
 # list_files returns a dictionary of instances
 # and for each instance, a list of (path,file) tuples
 # in order from new to old.
+# Every listed patch gets installed: a withdrawn one must not come from
+# a stale index.
 def list_patches(**kwargs):
     directory = kwargs['where']
 
-    all = _get_all_files_and_timestamp(kwargs['dav'], directory)
+    all = _get_all_files_and_timestamp(kwargs['dav'], directory, full=True)
 
     return all
 
 
 
-def peek_inside_local_file(path, fn):
+# Returns the name of the dump in a zip still in the cloud: only the
+# end of central directory and the central directory are downloaded.
+def peek_inside_remote_file(dav, path, size=-1):
     try:
-        z = zipfile.ZipFile(fn)
+        z = zipfile.ZipFile(dav.open(path, size))
     except Exception as e:
-        ufload.progress("Zipfile %s: could not read: %s" % (fn, e))
+        ufload.progress("Zipfile %s: could not read remotely: %s" % (path, e))
         return None
+    return _single_name(z, path)
 
+def _single_name(z, fn):
     names = z.namelist()
     if len(names) == 0:
         ufload.progress("Zipfile %s has no files in it." % fn)
@@ -235,33 +294,305 @@ def peek_inside_local_file(path, fn):
 def dlProgress(pct):
     ufload.progress("Downloaded %d%%" % pct)
 
-# Returns a file-like-object
-#def openDumpInZip(path, fn, **kwargs):
-def openDumpInZip(fn):
-    #file = open(fn, 'r')
-    z = zipfile.ZipFile(fn)
-    names = z.namelist()
-    if len(names) == 0:
-        logging.warn("Zipfile %s has no files in it." % fn)
-        return None, 0
-    if len(names) != 1:
-        logging.warn("Zipfile %s has unexpected files in it: %s" % (fn, names))
-        return None, 0
-    try:
-        file = z.open(names[0])
-    except:
-        logging.warn("Zipfile %s is probably corrupted" % fn)
-        return None, 0
+# Downloads files in a background thread so that the next backups
+# are already on disk while the current one is being restored.
+# fetch(key, job) must return the local filename (or None if there is
+# nothing to download). At most depth
+# files are kept ahead of the consumer, and no new download is started
+# while the files waiting on disk weight more than budget bytes
+# (0 = no limit).
+class Prefetcher(object):
+    def __init__(self, fetch, jobs, depth=1, budget=0):
+        self.fetch = fetch
+        self.jobs = list(jobs)
+        self.depth = max(1, depth)
+        self.budget = budget
+        self.ready = {}
+        self.waiting = 0
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='ufload-prefetch')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _room(self):
+        if len(self.ready) >= self.depth:
+            return False
+        if self.budget and self.ready and self.waiting >= self.budget:
+            return False
+        return True
 
-    filename = file.name
-    size = z.getinfo(names[0]).file_size
-    file.close()
-    z.close()
-    del file
-    del z
+    def _run(self):
+        for key, job in self.jobs:
+            with self.cond:
+                while not self.stopped and not self._room():
+                    self.cond.wait(1)
+                if self.stopped:
+                    return
+            try:
+                res = (self.fetch(key, job), None)
+                sz = 0
+                if res[0]:
+                    sz = os.path.getsize(res[0])
+            except Exception as e:
+                res = (None, e)
+                sz = 0
+            with self.cond:
+                self.ready[key] = res + (sz,)
+                self.waiting += sz
+                self.cond.notify_all()
+
+    # Returns the filename downloaded for key, waiting for it if needed.
+    # The exception raised by the download, if any, is raised again here.
+    def get(self, key):
+        with self.cond:
+            while key not in self.ready:
+                if not self.thread.is_alive():
+                    raise Exception("Prefetch of %s did not happen" % key)
+                self.cond.wait(1)
+            filename, err, sz = self.ready.pop(key)
+            self.waiting -= sz
+            self.cond.notify_all()
+        if err is not None:
+            raise err
+        return filename
+
+    # Stops the download thread and removes the files nobody asked for.
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+        for filename, err, sz in self.ready.values():
+            if filename:
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+        self.ready = {}
+
+# Inflates the only member of a zip while it is being downloaded: a
+# reader thread pulls the chunks of the HTTP response, an inflater
+# thread decompresses them, and read() hands the result over (to the
+# pg_restore pipe). Each stage waits on the next one through a bounded
+# queue, so no more than depth chunks are buffered between them.
+# A failure of the download or of the zip is kept in error and raised
+# by read(), once the data received before it has been read.
+class ZipStream(object):
+    chunk_size = 1024 * 1024
+    depth = 16
+
+    def __init__(self, response, chunk_size=None, depth=None):
+        self.response = response
+        if chunk_size:
+            self.chunk_size = chunk_size
+        if depth:
+            self.depth = depth
+        self.raw = Queue.Queue(self.depth)
+        self.out = Queue.Queue(self.depth)
+        self.pending = ''
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.name = None
+        self.size = 0
+        self.error = None
+        self.stopped = False
+        self.header = threading.Event()
+        self.threads = [threading.Thread(target=self._read, name='ufload-stream-read'),
+                        threading.Thread(target=self._inflate, name='ufload-stream-inflate')]
+        for t in self.threads:
+            t.daemon = True
+
+    # Starts the pipeline and waits for the local header of the member,
+    # which gives its name and size. When the member cannot be streamed,
+    # the stream is closed before raising.
+    def start(self):
+        for t in self.threads:
+            t.start()
+        while not self.header.is_set():
+            self.header.wait(1)
+        if self.name is None:
+            error = self.error or zipfile.BadZipfile('No file in the zip stream')
+            self.close()
+            raise error
+        return self
+
+    def _put(self, q, item):
+        while not self.stopped:
+            try:
+                q.put(item, True, 1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.stopped:
+            try:
+                return q.get(True, 1)
+            except Queue.Empty:
+                pass
+        return None
 
-    #return z.open(names[0]), z.getinfo(names[0]).file_size
-    return filename, size
+    def _fail(self, e):
+        # errors caused by close() are not the stream's fault
+        if self.error is None and not self.stopped:
+            self.error = e
+
+    def _read(self):
+        try:
+            for chunk in self.response.iter_content(chunk_size=self.chunk_size):
+                if chunk and not self._put(self.raw, chunk):
+                    return
+        except Exception as e:
+            self._fail(e)
+        self._put(self.raw, None)
+
+    def _take(self, n):
+        while len(self.pending) < n:
+            chunk = self._get(self.raw)
+            if chunk is None:
+                raise zipfile.BadZipfile('Unexpected end of the zip stream')
+            self.pending += chunk
+        data = self.pending[:n]
+        self.pending = self.pending[n:]
+        return data
+
+    def _inflate(self):
+        try:
+            self._inflate_member()
+        except Exception as e:
+            self._fail(e)
+        self.header.set()
+        self._put(self.out, None)
+
+    def _inflate_member(self):
+        sig, _, flags, method, _, _, crc, csize, usize, nlen, xlen = struct.unpack('<4s5H3L2H', self._take(30))
+        if sig != 'PK\x03\x04':
+            raise zipfile.BadZipfile('Not a zip stream')
+        name = self._take(nlen)
+        self._take(xlen)
+        # with bit 3 set, crc and sizes only follow the data
+        described = flags & 8
+        if method == zipfile.ZIP_DEFLATED:
+            d = zlib.decompressobj(-15)
+        elif method == zipfile.ZIP_STORED and not described and csize != 0xffffffff:
+            d = None
+            left = csize
+        else:
+            raise zipfile.BadZipfile('%s: unsupported zip entry (method %d, flags %x)' % (name, method, flags))
+        if not described and usize != 0xffffffff:
+            self.size = usize
+        self.name = name
+        self.header.set()
+
+        check = 0
+        data = self.pending
+        self.pending = ''
+        while True:
+            if d is not None:
+                out = d.decompress(data, self.chunk_size)
+                data = d.unconsumed_tail
+                rest = d.unused_data
+                if rest:
+                    out += d.flush()
+            else:
+                out, rest, data = data[:left], data[left:], ''
+                left -= len(out)
+            if out:
+                check = zlib.crc32(out, check)
+                if not self._put(self.out, out):
+                    return
+            if rest or (d is None and left == 0):
+                break
+            if not data:
+                data = self._get(self.raw)
+                if data is None:
+                    raise zipfile.BadZipfile('%s: unexpected end of the zip stream' % name)
+
+        if described:
+            self.pending = rest
+            crc = self._take(4)
+            if crc == 'PK\x07\x08':
+                crc = self._take(4)
+            crc = struct.unpack('<L', crc)[0]
+        if check & 0xffffffff != crc:
+            raise zipfile.BadZipfile('Bad CRC-32 for %s' % name)
+
+    def read(self, n=-1):
+        while self.pos >= len(self.buf) and not self.eof:
+            chunk = self._get(self.out)
+            if chunk is None:
+                self.eof = True
+            else:
+                self.buf = chunk
+                self.pos = 0
+        if self.eof and self.pos >= len(self.buf):
+            if self.error is not None:
+                raise self.error
+            return ''
+        if n < 0:
+            n = len(self.buf) - self.pos
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += len(data)
+        return data
+
+    # Stops the threads and drops the connection, the stream being
+    # read up to its end or not.
+    def close(self):
+        self.stopped = True
+        try:
+            self.response.close()
+        except Exception:
+            pass
+        for t in self.threads:
+            if t.is_alive():
+                t.join(5)
+
+
+# A backup zip, opened once for the whole restore. Its only member is
+# the dump, whose name and size come from the central directory. The
+# CRC-32 is checked by member as the dump is read: reading its last
+# bytes raises zipfile.BadZipfile when it does not match.
+# The constructor raises when the zip cannot be used (no or several
+# members, truncated file, bad local header, data which does not
+# inflate), so that the next backup can be tried right away.
+class DumpZip(object):
+    def __init__(self, fn):
+        self.filename = fn
+        self.fileobj = open(fn, 'rb')
+        try:
+            self.zip = zipfile.ZipFile(self.fileobj)
+            infos = self.zip.infolist()
+            if len(infos) != 1:
+                raise zipfile.BadZipfile("%s has %d files in it" % (fn, len(infos)))
+            info = infos[0]
+            self.name = info.filename
+            self.size = info.file_size
+            self.compress_size = info.compress_size
+            if info.header_offset + info.compress_size > os.fstat(self.fileobj.fileno()).st_size:
+                raise zipfile.BadZipfile("%s is truncated" % fn)
+            self.member = self.zip.open(info)
+            # inflate the first block now rather than once pg_restore runs
+            self.member.peek(1)
+        except:
+            self.fileobj.close()
+            raise
+
+    # Writes the dump to path, checking its CRC-32 on the way
+    def extract(self, path):
+        with open(path, 'wb') as out:
+            shutil.copyfileobj(self.member, out, 1024 * 1024)
+        return path
+
+    def close(self):
+        self.member.close()
+        self.zip.close()
+        self.fileobj.close()
 
 
 # An object that copies input to output, calling
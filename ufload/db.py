@@ -1,33 +1,55 @@
-import os, sys, subprocess, tempfile, hashlib, urllib, oerplib, zipfile, base64
+import os, sys, subprocess, tempfile, hashlib, urllib, oerplib, base64, fnmatch, copy, multiprocessing, stat
 import ufload
 import re
+import collections
+import pg
+import threading
+import Queue
+import time
+import zipfile
 from base64 import encodestring
 
 def _run_out(args, cmd):
+    if isinstance(cmd, _Psql) and pg.available():
+        rc, out = pg.execute(args, cmd.sql, cmd.db)
+        if rc != 0:
+            return []
+        return out.split('\n')
     try:
         return subprocess.check_output(cmd, env=pg_pass(args), stderr=subprocess.STDOUT).split('\n')
     except Exception:
         return []
 
-def _run(args, cmd, get_out=False, silent=False):
+def _run(args, cmd, get_out=False, silent=False, pgoptions=None):
     if args.show:
         ufload.progress("Would run: " + str(cmd))
         rc = 0
+    elif isinstance(cmd, _Psql) and pg.available():
+        if silent or get_out:
+            return pg.execute(args, cmd.sql, cmd.db)
+        rc = pg.run(args, cmd.sql, cmd.db)
     else:
         if silent or get_out:
             out = ""
             try:
-                out = subprocess.check_output(cmd, env=pg_pass(args), stderr=subprocess.STDOUT)
+                out = subprocess.check_output(cmd, env=pg_pass(args, pgoptions), stderr=subprocess.STDOUT)
                 return 0, out
             except subprocess.CalledProcessError as exc:
                 return exc.returncode, exc.output
         else:
-            rc = subprocess.call(cmd, env=pg_pass(args))
+            rc = subprocess.call(cmd, env=pg_pass(args, pgoptions))
     return rc
 
 # Find exe by looking in the PATH, prefering the one
 # installed by the AIO (UF6.0 style or pre-UF6 style)
 def _find_exe(exe):
+    if exe not in _exes:
+        _exes[exe] = _lookup_exe(exe)
+    return _exes[exe]
+
+_exes = {}
+
+def _lookup_exe(exe):
     if sys.platform == "win32":
         path = [ r'c:\Program Files (x86)\msf\Unifield\pgsql\bin',
                  r'd:\MSF Data\Unifield\PostgreSQL\bin' ]
@@ -60,16 +82,174 @@ def pg_common(args):
 
 def pg_restore(args):
     cmd = [ _find_exe('pg_restore') ] + pg_common(args)
-    if args.jobs:
+    # -jobs auto is decided in _restore_file, once the dump is known
+    if args.jobs and args.jobs != 'auto':
         cmd += ['-j', '%s'%args.jobs]
     return cmd
 
-def pg_pass(args):
+# Dump size worth one more pg_restore job, for -jobs auto
+auto_jobs_bytes = 256 * 1024 * 1024
+
+def _setting(args, sql):
+    v = filter(len, map(lambda x: x.strip(), _run_out(args, mkpsql(args, sql))))
+    try:
+        return int(v[0])
+    except (IndexError, ValueError):
+        return None
+
+# Picks the number of pg_restore jobs for the dump file fn (-jobs auto):
+# one per auto_jobs_bytes of dump, but no more than the tables and
+# indexes to restore, than the CPUs and the free Postgres connections
+# and workers, both shared between the -parallel restores.
+def auto_jobs(args, fn):
+    parallel = max(1, getattr(args, 'parallel', 1) or 1)
+    toc = _run_out(args, [ _find_exe('pg_restore'), '-l', fn ])
+    tables = len([ l for l in toc if not l.startswith(';') and ' TABLE DATA ' in l ])
+    indexes = len([ l for l in toc if not l.startswith(';') and (' INDEX ' in l or ' CONSTRAINT ' in l) ])
+    size = os.path.getsize(fn)
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+
+    limits = [ ('%d Mb of dump' % (size / (1024 * 1024)), 1 + size / auto_jobs_bytes),
+               ('%d CPUs' % cpus, cpus / parallel) ]
+    if tables or indexes:
+        limits.append(('%d tables and %d indexes' % (tables, indexes), max(tables, indexes)))
+    conns = _setting(args, "select current_setting('max_connections')::int - current_setting('superuser_reserved_connections')::int - (select count(*) from pg_stat_activity)")
+    if conns is not None:
+        limits.append(('%d free connections' % conns, conns / parallel))
+    workers = _setting(args, 'show max_worker_processes')
+    if workers is not None:
+        limits.append(('max_worker_processes %d' % workers, workers / parallel))
+
+    jobs = max(1, min(n for why, n in limits))
+    ufload.progress("-jobs auto: %d jobs (%s%s)" % (jobs, ', '.join('%s: %d' % (why, n) for why, n in limits),
+                                                    ', %d restores at once' % parallel if parallel > 1 else ''))
+    return jobs
+
+# pgoptions: session settings of the Postgres backends, as a dict
+def pg_pass(args, pgoptions=None):
     env = os.environ.copy()
     if args.db_pw is not None:
         env['PGPASSWORD'] = args.db_pw
+    if pgoptions:
+        opts = [ '-c %s=%s' % (k, pgoptions[k]) for k in sorted(pgoptions) ]
+        env['PGOPTIONS'] = ' '.join(filter(None, [ env.get('PGOPTIONS') ] + opts))
     return env
 
+# Whether pg_restore has to read the dump from a file rather than a pipe
+def needs_file(args):
+    # pg_restore -j cannot read from standard input, and Windows
+    # pg_restore gets confused when reading from a pipe
+    return sys.platform == "win32" or bool(args.jobs) or args.sections
+
+# Session settings of the backends loading the data (-sections): the
+# data is thrown away if the restore fails, so durability is not needed
+bulk_load = {
+    'synchronous_commit': 'off',
+}
+
+# Memory in Mb shared by the backends building the indexes and
+# constraints, unless -maintenance-mb is given
+maintenance_mb = 1024
+
+# Session settings of each of the jobs backends building the indexes and
+# constraints
+def post_data(args, jobs):
+    mb = getattr(args, 'maintenance_mb', None) or maintenance_mb
+    return { 'maintenance_work_mem': '%dMB' % max(64, mb / jobs) }
+
+# Tables whose data is left out by -slim, unless -slim-tables is given
+slim_tables = 'ir_attachment,audittrail_log_line,sync_client_update_*,sync_client_message_*'
+
+# Writes the TOC of the dump fn without the TABLE DATA entries of the
+# tables matching the -slim-tables patterns, for pg_restore -L. Returns
+# the name of the list file.
+def _slim_list(args, fn):
+    patterns = filter(None, [ x.strip() for x in (args.slim_tables or slim_tables).split(',') ])
+    toc = subprocess.check_output([ _find_exe('pg_restore'), '-l', fn ], env=pg_pass(args))
+    skipped = []
+    lines = []
+    for line in toc.split('\n'):
+        # 1234; 0 16390 TABLE DATA public ir_attachment openpg
+        v = line.split()
+        if not line.startswith(';') and len(v) >= 7 and v[3:5] == [ 'TABLE', 'DATA' ] and \
+                any(fnmatch.fnmatchcase(v[6], p) for p in patterns):
+            skipped.append(v[6])
+            line = ';' + line
+        lines.append(line)
+    ufload.progress("Slim restore, without the data of: %s" % (', '.join(skipped) or 'no table'))
+
+    tf = tempfile.NamedTemporaryFile(suffix='.list', delete=False)
+    tf.write('\n'.join(lines))
+    tf.close()
+    return tf.name
+
+# Restores the dump file fn with the pg_restore command cmd. With slim,
+# the data of the -slim-tables is not restored. With -sections,
+# pre-data, data and post-data are restored one after the other: data
+# with the bulk load settings, post-data with -post-jobs jobs. The time
+# each one took is logged.
+def _restore_file(args, cmd, fn, slim=False):
+    if args.jobs == 'auto':
+        jobs = 1 if args.show else auto_jobs(args, fn)
+        if jobs > 1:
+            cmd = cmd + [ '-j', '%d' % jobs ]
+        args = copy.copy(args)
+        args.jobs = jobs
+
+    if slim and not args.show:
+        lst = _slim_list(args, fn)
+        try:
+            return _restore_file(args, cmd + [ '-L', lst ], fn)
+        finally:
+            os.unlink(lst)
+
+    if not args.sections:
+        return _run(args, cmd + [ fn ])
+
+    # the -j of pg_restore(args) is decided for each section
+    base = []
+    skip = False
+    for x in cmd:
+        if skip:
+            skip = False
+        elif x == '-j':
+            skip = True
+        else:
+            base.append(x)
+
+    jobs = args.jobs or 1
+    post_jobs = args.post_jobs or jobs
+    sections = [
+        ('pre-data', 1, None),
+        ('data', jobs, bulk_load),
+        ('post-data', post_jobs, post_data(args, post_jobs)),
+    ]
+    times = []
+    for section, j, options in sections:
+        c = base + [ '--section=%s' % section ]
+        if j > 1:
+            c += [ '-j', '%d' % j ]
+        ufload.progress("Restoring %s (%d jobs)" % (section, j))
+        start = time.time()
+        rc = _run(args, c + [ fn ], pgoptions=options)
+        times.append('%s %ds' % (section, time.time() - start))
+        if rc != 0:
+            ufload.progress("Restore of %s failed" % section)
+            break
+    ufload.progress("Restore times: %s" % ', '.join(times))
+    return rc
+
+# A psql command line which remembers its statement, so that _run and
+# _run_out can send it on a pooled connection instead (see ufload.pg)
+class _Psql(list):
+    def __init__(self, cmd, sql, db):
+        list.__init__(self, cmd)
+        self.sql = sql
+        self.db = db
+
 def mkpsql(args, sql, db='postgres'):
     cmd = [ _find_exe('psql') ] + pg_common(args)
     cmd.append('-q')
@@ -77,7 +257,7 @@ def mkpsql(args, sql, db='postgres'):
     cmd.append('-c')
     cmd.append(sql)
     cmd.append(db)
-    return cmd
+    return _Psql(cmd, sql, db)
 
 def mkpsql_file(args, file, db='postgres'):
     cmd = [ _find_exe('psql') ] + pg_common(args)
@@ -89,12 +269,125 @@ def mkpsql_file(args, file, db='postgres'):
     return cmd
 
 def psql(args, sql, db='postgres', silent=False):
-    return _run(args, mkpsql(args, sql, db), silent)
+    res = _run(args, mkpsql(args, sql, db), silent)
+    rc = res[0] if isinstance(res, tuple) else res
+    if rc == 0:
+        _catalog_update(args, sql)
+    return res
 
 def psql_file(args, file, db='postgres', silent=False):
     return _run(args, mkpsql_file(args, file, db), silent)
     
-def load_zip_into(args, db, f, sz):
+# Whether f is an open regular file
+def _regular_file(f):
+    try:
+        return stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, EnvironmentError, ValueError):
+        return False
+
+# Seconds between two looks at the progress of _file_restore
+progress_interval = 1
+
+# Same as _pipe_restore for a regular file: pg_restore gets it as its
+# standard input, so the kernel reads it for pg_restore and nothing is
+# copied through Python. pg_restore shares the file offset with us: it
+# is sampled every progress_interval seconds to show the progress.
+def _file_restore(args, cmd, f, sz):
+    fd = f.fileno()
+    os.lseek(fd, f.tell(), os.SEEK_SET)
+    p = subprocess.Popen(cmd, stdin=fd,
+                         stdout=sys.stdout,
+                         stderr=sys.stderr,
+                         env=pg_pass(args))
+
+    tot = float(sz)
+    next = 10
+    while p.poll() is None:
+        time.sleep(progress_interval)
+        if tot == 0 or next > 100:
+            continue
+        try:
+            pct = os.lseek(fd, 0, os.SEEK_CUR) / tot * 100
+        except OSError:
+            continue
+        if pct > next:
+            ufload.progress("Restoring: %d%%" % int(pct))
+            next = int(pct / 10) * 10 + 10
+            if next > 100:
+                ufload.progress("Waiting for Postgres to finish restore")
+    return p.returncode
+
+# Feeds the dump read from f into the standard input of pg_restore,
+# showing the progress against sz bytes. Returns the pg_restore result code.
+def _pipe_restore(args, cmd, f, sz):
+    if _regular_file(f):
+        return _file_restore(args, cmd, f, sz)
+
+    tot = float(sz)
+    p = subprocess.Popen(cmd, bufsize=1024 * 1024 * 10,
+                         stdin=subprocess.PIPE,
+                         stdout=sys.stdout,
+                         stderr=sys.stderr,
+                         env=pg_pass(args))
+
+    n = 0
+    next = 10
+    try:
+        for chunk in iter(lambda: f.read(8192), b''):
+            try:
+                p.stdin.write(chunk)
+            except IOError:
+                break
+            n += len(chunk)
+            if tot != 0:
+                pct = n / tot * 100
+                if pct > next:
+                    ufload.progress("Restoring: %d%%" % int(pct))
+                    next = int(pct / 10) * 10 + 10
+    except:
+        # reading the dump failed: pg_restore gets a truncated input
+        p.stdin.close()
+        p.wait()
+        raise
+
+    p.stdin.close()
+    ufload.progress("Restoring: 100%")
+    ufload.progress("Waiting for Postgres to finish restore")
+    return p.wait()
+
+# Restores the dump of dz, a ufload.cloud.DumpZip
+def load_zip_into(args, db, dz, sz):
+    return _load_into(args, db, sz, lambda cmd: _restore_zip(args, cmd, dz, sz))
+
+# Same as load_zip_into, from the dump inflated on the fly out of the
+# cloud (see ufload.cloud.ZipStream): nothing is written to disk.
+def load_stream_into(args, db, stream, sz):
+    return _load_into(args, db, sz, lambda cmd: _pipe_restore(args, cmd, stream, sz))
+
+def _restore_zip(args, cmd, dz, sz):
+    if needs_file(args) or args.slim:
+        fn = dz.name
+        try:
+            dz.extract(fn)
+            dz.close()
+            os.unlink(dz.filename)
+
+            return _restore_file(args, cmd, fn, args.slim)
+        finally:
+            # clean up the temp file
+            try:
+                os.unlink(fn)
+            except OSError:
+                pass
+
+    # Inflate the dump straight into pg_restore: it never touches the disk.
+    # The zip stays readable through dz until it is closed.
+    os.unlink(dz.filename)
+    return _pipe_restore(args, cmd, dz.member, sz)
+
+# Restores into a temp database with restore(cmd), cmd being the
+# pg_restore command line without its input, then swaps it with db.
+def _load_into(args, db, sz, restore):
     if sz == 0:
         ufload.progress("Note: No progress percent available.")
     
@@ -125,30 +418,11 @@ def load_zip_into(args, db, f, sz):
         cmd.append('--disable-triggers')
 
         if not args.show:
-            with open(f, 'rb') as fileobj:
-                z = zipfile.ZipFile(fileobj)
-                names = z.namelist()
-                fn = names[0]
-                #z.extract(fn)
-                z.extractall()
-                z.close()
-                del z
-            os.unlink(f)
-
-            cmd.append(fn)
-
             ufload.progress("Starting restore. This will take some time.")
             try:
-                rc =_run(args, cmd)
+                rc = restore(cmd)
             except KeyboardInterrupt:
                 raise dbException(1)
-
-            # clean up the temp file
-            try:
-                os.unlink(fn)
-            except OSError:
-                pass
-
         else:
             ufload.progress("Would run: "+ str(cmd))
             rc = 0
@@ -190,21 +464,27 @@ def load_zip_into(args, db, f, sz):
         # analyze db
         psql(args, 'analyze', db, silent=True)
 
+        # Temp databases of this run belong to restores still in progress (-parallel)
+        ours = "_" + str(os.getpid())
+        victims = []
         for d in _allDbs(args):
-            if d.startswith(db) and d!=db:
+            if d.startswith(db) and d!=db and not d.endswith(ours):
                 ufload.progress("Cleaning other database for instance %s: %s" % (db, d))
-                killCons(args, d)
-                rc = psql(args, 'DROP DATABASE IF EXISTS \"%s\"' % d)
-                if rc != 0:
-                    return rc
+                victims.append(d)
+        if dropDbs(args, victims):
+            return 1
 
         return 0
     except Exception:
-        ufload.progress("Unexpected error %s" % sys.exc_info()[0])
+        exc = sys.exc_info()
+        ufload.progress("Unexpected error %s" % exc[0])
         # something went wrong, so drop the temp table
         ufload.progress("Cleanup: dropping table %s" % db2)
         killCons(args, db2)
         psql(args, 'DROP DATABASE \"%s\"'%db2)
+        if issubclass(exc[0], zipfile.BadZipfile):
+            # a damaged backup: the caller tries another one
+            raise exc[0], exc[1], exc[2]
         return 1
 
 
@@ -242,7 +522,16 @@ def load_dump_into(args, db, f, sz):
         # Windows pg_restore gets confused when reading from a pipe,
         # so write to a temp file first.
         #if sys.platform == "win32":
-        if sys.platform == "win32" or args.jobs :  #  pg_restore from standard input cannot use -j option
+        # -slim needs the table of contents: pg_restore -l reads a file
+        to_file = needs_file(args) or args.slim
+        if to_file and _regular_file(f):
+            # the dump is already a file
+            ufload.progress("Starting restore. This will take some time.")
+            try:
+                rc = _restore_file(args, cmd, f.name, args.slim)
+            except KeyboardInterrupt:
+                raise dbException(1)
+        elif to_file:
             tf = tempfile.NamedTemporaryFile(delete=False)
             if not args.show:
 
@@ -258,11 +547,10 @@ def load_dump_into(args, db, f, sz):
                             next = int(pct / 10) * 10 + 10
 
             tf.close()
-            cmd.append(tf.name)
 
             ufload.progress("Starting restore. This will take some time.")
             try:
-                rc = _run(args, cmd)
+                rc = _restore_file(args, cmd, tf.name, args.slim)
             except KeyboardInterrupt:
                 raise dbException(1)
 
@@ -275,30 +563,7 @@ def load_dump_into(args, db, f, sz):
             # For non-Windows, feed the data in via pipe so that we have
             # some progress indication.
             if not args.show:
-                p = subprocess.Popen(cmd, bufsize=1024 * 1024 * 10,
-                                     stdin=subprocess.PIPE,
-                                     stdout=sys.stdout,
-                                     stderr=sys.stderr,
-                                     env=pg_pass(args))
-
-                n = 0
-                next = 10
-                for chunk in iter(lambda: f.read(8192), b''):
-                    try:
-                        p.stdin.write(chunk)
-                    except IOError:
-                        break
-                    n += len(chunk)
-                    if tot != 0:
-                        pct = n / tot * 100
-                        if pct > next:
-                            ufload.progress("Restoring: %d%%" % int(pct))
-                            next = int(pct / 10) * 10 + 10
-
-                p.stdin.close()
-                ufload.progress("Restoring: 100%")
-                ufload.progress("Waiting for Postgres to finish restore")
-                rc = p.wait()
+                rc = _pipe_restore(args, cmd, f, sz)
             else:
                 ufload.progress("Would run: " + str(cmd))
                 rc = 0
@@ -339,6 +604,109 @@ def load_dump_into(args, db, f, sz):
         psql(args, 'DROP DATABASE \"%s\"' % db2)
         return 1
 
+# The steps of a SQL plan, run as one transaction by run_plan. The
+# statements use %(name)s placeholders for their parameters, which are
+# bound by the driver (or passed as psql variables), never pasted in.
+# A step which is not required may fail without stopping the plan.
+class Plan(object):
+    def __init__(self):
+        self.steps = []
+        self.params = {}
+
+    def add(self, label, sql, required=True, **params):
+        n = len(self.steps)
+        for k, v in params.items():
+            name = 's%d_%s' % (n, k)
+            sql = sql.replace('%%(%s)s' % k, '%%(%s)s' % name)
+            self.params[name] = v
+        self.steps.append((label, sql, required))
+
+    # The plan as a psql script, parameters being psql variables, or
+    # quoted in the script itself with inline (psql older than 9.0)
+    def script(self, inline=False):
+        def param(m):
+            if m.group(1) is None:
+                return '%'
+            if inline:
+                return _script_literal(_psql_value(self.params[m.group(1)]))
+            return ":'%s'" % m.group(1)
+
+        lines = []
+        for n, (label, sql, required) in enumerate(self.steps):
+            sql = re.sub(r'%\((\w+)\)s|%%', param, sql)
+            lines.append('\\echo ufload-step: %d' % n)
+            if required:
+                lines.append(sql + ';')
+            else:
+                lines.append('\\set ON_ERROR_STOP off')
+                lines.append('\\set ON_ERROR_ROLLBACK on')
+                lines.append(sql + ';')
+                lines.append('\\set ON_ERROR_ROLLBACK off')
+                lines.append('\\set ON_ERROR_STOP on')
+        return '\n'.join(lines) + '\n'
+
+# A parameter of a plan as text: a list becomes an array literal
+def _psql_value(v):
+    if isinstance(v, list):
+        return '{%s}' % ','.join('"%s"' % x.replace('\\', '\\\\').replace('"', '\\"') for x in v)
+    return '%s' % v
+
+# Quotes s for a script run by an old psql, whose server may still
+# have standard_conforming_strings off
+def _script_literal(s):
+    if '\\' in s:
+        return "E'%s'" % s.replace('\\', '\\\\').replace("'", "''")
+    return _literal(s)
+
+# The version of psql, as a tuple of ints. Asked once per run; (0,)
+# when it cannot be told.
+_psql_versions = {}
+
+def _psql_version():
+    exe = _find_exe('psql')
+    if exe not in _psql_versions:
+        try:
+            out = subprocess.Popen([ exe, '--version' ], stdout=subprocess.PIPE).communicate()[0]
+            m = re.search(r'(\d+)\.(\d+)', out)
+            _psql_versions[exe] = (int(m.group(1)), int(m.group(2)))
+        except (OSError, AttributeError):
+            _psql_versions[exe] = (0,)
+    return _psql_versions[exe]
+
+# Runs plan on db in a single transaction and session. Returns (rc, label
+# of the step which failed, error message).
+def run_plan(args, plan, db):
+    if args.show:
+        for label, sql, required in plan.steps:
+            ufload.progress("Would run (%s): %s" % (label, sql))
+        return 0, None, None
+    if pg.available():
+        return pg.execute_plan(args, plan.steps, plan.params, db)
+
+    cmd = [ _find_exe('psql') ] + pg_common(args)
+    cmd += [ '-q', '-t', '-1', '-v', 'ON_ERROR_STOP=1' ]
+    # the :'name' variables need psql >= 9.0
+    inline = _psql_version() < (9, 0)
+    if not inline:
+        for k in sorted(plan.params):
+            cmd += [ '-v', '%s=%s' % (k, _psql_value(plan.params[k])) ]
+    cmd += [ '-f', '-', db ]
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, env=pg_pass(args))
+    out, _ = p.communicate(plan.script(inline))
+    if p.returncode == 0:
+        return 0, None, None
+
+    label = None
+    errors = []
+    for line in out.split('\n'):
+        if line.startswith('ufload-step: '):
+            label = plan.steps[int(line[len('ufload-step: '):])][0]
+            errors = []
+        elif line.strip():
+            errors.append(line)
+    return p.returncode, label, '\n'.join(errors)
+
 # De-live uses psql to change a restored database taken from a live backup
 # into a non-production, non-live database. It:
 # 1. stomps all existing passwords
@@ -353,6 +721,20 @@ def delive(args, db):
             ufload.progress("(please note that ufload is not able to connect to the sync server using live passwords, please connect manually)")
         return 0
 
+    rc, label, error = run_plan(args, _delive_plan(args, db), db)
+    if rc != 0:
+        ufload.progress("Delive of %s failed at step '%s': %s" % (db, label, error))
+        return rc
+
+    if args.nopwreset:
+        ufload.progress("*** WARNING: The restored database has LIVE passwords.")
+
+    # ok, delive finished with no problems
+    return 0
+
+def _delive_plan(args, db):
+    plan = Plan()
+
     adminuser = args.adminuser.lower()
     port = 8069
     if args.sync_xmlrpcport:
@@ -367,88 +749,60 @@ def delive(args, db):
         pfx = args.db_prefix + '_'
     else:
         pfx = ''
-    rc = psql(args, 'alter table sync_client_sync_server_connection ADD COLUMN IF NOT EXISTS ufload_automatic_patching_prod_value boolean;', db)
-    rc = psql(args, 'update sync_client_sync_server_connection set ufload_automatic_patching_prod_value=automatic_patching;', db)
-    rc = psql(args, 'update sync_client_sync_server_connection set automatic_patching = \'f\', protocol = \'xmlrpc\', login = \'%s\', database = \'%s%s\', host = \'127.0.0.1\', port = %d;' % (adminuser, pfx, ss, port), db)
-    if rc != 0:
-        return rc
+    plan.add('keep automatic patching', 'alter table sync_client_sync_server_connection ADD COLUMN IF NOT EXISTS ufload_automatic_patching_prod_value boolean', False)
+    plan.add('save automatic patching', 'update sync_client_sync_server_connection set ufload_automatic_patching_prod_value=automatic_patching', False)
+    plan.add('local sync server', "update sync_client_sync_server_connection set automatic_patching = 'f', protocol = 'xmlrpc', login = %(login)s, database = %(db)s, host = '127.0.0.1', port = %(port)s",
+             login=adminuser, db=pfx + ss, port=port)
 
     # disable cron jobs
-    rc = psql(args, "update ir_cron set active = 'f' where model in ('backup.config', 'unidata.sync');", db)
-    if rc != 0:
-        return rc
-    rc = psql(args, 'update ir_cron set active = \'f\' where model = \'msf.instance.cloud\';', db)
-    if rc != 0:
-        return rc
-    rc = psql(args, 'update ir_cron set active = \'f\' where model = \'sync.client.entity\';', db)
-    if rc != 0:
-        return rc
-    rc = psql(args, 'update ir_cron set active = \'f\' where model = \'stock.mission.report\';', db)
-    if rc != 0:
-        return rc
+    plan.add('disable cron jobs', "update ir_cron set active = 'f' where model = any(%(models)s)",
+             models=[ 'backup.config', 'unidata.sync', 'msf.instance.cloud', 'sync.client.entity',
+                      'stock.mission.report', 'automated.import', 'automated.export' ])
 
-    #Automated import jobs
-    rc = psql(args, 'update ir_cron set active = \'f\' where model = \'automated.import\';', db)
-    if rc != 0:
-        return rc
-    # Automated import settings
-    psql(args, 'UPDATE automated_import SET report_path=\'\', src_path=\'\', ftp_url=\'\', dest_path=\'\', ftp_ok=\'f\', ftp_port=\'\',dest_path_failure=\'\', ftp_login=\'\', ftp_password=\'\', ftp_protocol=\'\';', db)
-
-    # Automated export jobs
-    rc = psql(args, 'update ir_cron set active = \'f\' where model = \'automated.export\';', db)
-    if rc != 0:
-        return rc
-    # Automated export settings
-    psql(args, 'UPDATE automated_export SET report_path=\'\', ftp_url=\'\', dest_path=\'\', ftp_ok=\'f\', ftp_port=\'\',dest_path_failure=\'\', ftp_login=\'\', ftp_password=\'\', ftp_protocol=\'\';', db)
+    # Automated import and export settings
+    plan.add('clear automated imports', "UPDATE automated_import SET report_path='', src_path='', ftp_url='', dest_path='', ftp_ok='f', ftp_port='',dest_path_failure='', ftp_login='', ftp_password='', ftp_protocol=''", False)
+    plan.add('clear automated exports', "UPDATE automated_export SET report_path='', ftp_url='', dest_path='', ftp_ok='f', ftp_port='',dest_path_failure='', ftp_login='', ftp_password='', ftp_protocol=''", False)
 
     # Now we check for arguments allowing auto-sync and silent-upgrade
     if args.autosync:
-        activate_autosync(args, db, ss)
-        rc = psql(args, 'update ir_cron set active = \'t\', interval_type = \'hours\', interval_number = 2, nextcall = current_timestamp + interval \'1 hour\' where model = \'sync.client.entity\' and function = \'sync_threaded\';', db)
-        if rc != 0:
-            return rc
-        rc = psql(args, 'update sync_client_sync_server_connection SET host = \'127.0.0.1\', database = \'%s\';' % ss, db)
+        autosync_steps(plan, ss)
 
     if args.silentupgrade:
         if not args.autosync:
             ufload.progress("*** WARNING: Silent upgrade is enabled, but auto sync is not.")
-        rc = psql(args, 'update sync_client_sync_server_connection set automatic_patching = \'t\';', db)
-        if rc != 0:
-            return rc
+        silentupgrade_steps(plan)
 
     if args.hidegroups:
-        psql(args, "truncate ir_ui_view_sc;", db)
+        plan.add('clear shortcuts', "truncate ir_ui_view_sc", False)
         for to_del in args.hidegroups.split(','):
-            psql(args, "update res_groups set visible_res_groups='f' where name ilike '%s';" % to_del, db)
-            psql(args, "delete from res_groups_users_rel where gid in (select g.id from res_groups g where g.visible_res_groups='f');", db)
+            plan.add('hide group %s' % to_del, "update res_groups set visible_res_groups='f' where name ilike %(name)s", False, name=to_del)
+            plan.add('remove hidden group users', "delete from res_groups_users_rel where gid in (select g.id from res_groups g where g.visible_res_groups='f')", False)
 
     if args.logo:
-         psql(args, "update res_company set logo='%s';" % base64.encodestring(open(args.logo, 'rb').read()), db)
+        plan.add('logo', "update res_company set logo=%(logo)s", False, logo=base64.encodestring(open(args.logo, 'rb').read()))
 
     if args.banner:
-         psql(args, "update communication_config set message=$ESC$%s$ESC$;" % args.banner, db)
+        plan.add('banner', "update communication_config set message=%(banner)s", False, banner=args.banner)
 
     # Set the backup directory
-    directory = "E'd:\\\\'"
+    directory = 'd:\\'
     if sys.platform != "win32" and args.db_host in [ None, 'ct0', 'localhost' ]:
         # when loading on non-windows, to a local database, use /tmp
-        directory = '\'/tmp\''
+        directory = '/tmp'
 
-    rc = psql(args, 'update backup_config set beforemanualsync=\'f\', beforepatching=\'f\', aftermanualsync=\'f\', beforeautomaticsync=\'f\', afterautomaticsync=\'f\', scheduledbackup=\'f\', name = %s;' % directory, db)
-    if rc != 0:
-        return rc
+    plan.add('backup config', "update backup_config set beforemanualsync='f', beforepatching='f', aftermanualsync='f', beforeautomaticsync='f', afterautomaticsync='f', scheduledbackup='f', name = %(dir)s", dir=directory)
 
     # put the chosen password into all users
     if args.userspw:
-        rc = psql(args, 'update res_users set password = \'%s\' WHERE id <> 1;' % args.userspw, db)
+        plan.add('users password', "update res_users set password = %(pw)s WHERE id <> 1", False, pw=args.userspw)
 
     if args.pwlist:
         for pwlist in args.pwlist.split(','):
             user, newpw = pwlist.split(':')
-            psql(args, 'update res_users set password = \'%s\' WHERE login =\'%s\';' % (newpw, user), db)
+            plan.add('password of %s' % user, "update res_users set password = %(pw)s WHERE login = %(login)s", False, pw=newpw, login=user)
 
     if args.adminpw:
-        rc = psql(args, 'update res_users set password = \'%s\' WHERE id = 1;' % args.adminpw, db)
+        plan.add('admin password', "update res_users set password = %(pw)s WHERE id = 1", False, pw=args.adminpw)
 
     if args.createusers:
         if args.adminpw != args.userspw:
@@ -495,67 +849,92 @@ def delive(args, db):
 
             if not new_user_name:
                 new_user_name = new_user
-            rc, new_userid = psql(args, """ insert into res_users (name, active, login, password, context_lang, company_id, view, menu_id) values
-                ('%s', 't', '%s', '%s', 'en_MF', 1, 'simple', 1) returning id;"""
-                % (new_user_name, new_user.lower(), new_user_pass), db, silent=True)
-            if rc != 0:
-                return rc
+            # the new user is found again by its login, which is unique
+            login = new_user.lower()
+            plan.add('create user %s' % login, """insert into res_users (name, active, login, password, context_lang, company_id, view, menu_id) values
+                (%(name)s, 't', %(login)s, %(pw)s, 'en_MF', 1, 'simple', 1)""", name=new_user_name, login=login, pw=new_user_pass)
             if new_user_dpt:
-                psql(args, """ update res_users u set context_department_id = d.id
+                plan.add('department of %s' % login, """update res_users u set context_department_id = d.id
                     from hr_department d
-                    where d.name = '%s' and u.id = %s """ % (new_user_dpt, new_userid), db)
+                    where d.name = %(dpt)s and u.login = %(login)s""", False, dpt=new_user_dpt, login=login)
 
             if new_user_email:
-                rc, address_id = psql(args, """ insert into res_partner_address (name, email) values ('%s', '%s') returning id """ % (new_user_name, new_user_email), db, silent=True)
-                if address_id:
-                    psql(args,"update res_users set address_id=%s where id=%s" % (address_id, new_userid), db)
- 
+                plan.add('address of %s' % login, """insert into res_partner_address (name, email) values (%(name)s, %(email)s);
+                    update res_users set address_id = currval(pg_get_serial_sequence('res_partner_address', 'id')) where login = %(login)s""",
+                         False, name=new_user_name, email=new_user_email, login=login)
+
             for new_group in  groups.split(','):
-                rc = psql(args, " insert into res_groups_users_rel (uid, gid) (select %s, id from res_groups where name='%s');" % (new_userid, new_group), db)
-                if rc != 0:
-                    return rc
+                plan.add('group %s of %s' % (new_group, login), "insert into res_groups_users_rel (uid, gid) (select u.id, g.id from res_users u, res_groups g where u.login = %(login)s and g.name = %(group)s)",
+                         login=login, group=new_group)
 
     if args.nopwreset:
-        ufload.progress("*** WARNING: The restored database has LIVE passwords.")
-        return 0
+        return plan
 
     # set the username of the admin account
-    rc = psql(args, 'update res_users set login = \'%s\' where id = 1;' % adminuser, db)
-    if rc != 0:
-        return rc
-
-    # put the chosen password into all users
-    #rc = psql(args, 'update res_users set password = \'%s\';' % args.adminpw, db)
-    if rc != 0:
-        return rc
+    plan.add('admin login', "update res_users set login = %(login)s where id = 1", login=adminuser)
 
     if args.inactiveusers:
-        rc = psql(args, "update res_users set active = 'f' where login not in ('synch', '%s');" % adminuser, db)
-
-
-    # ok, delive finished with no problems
-    return 0
-
-def activate_autosync(args, db, ss):
-    rc = psql(args,
-              'update ir_cron set active = \'t\', interval_type = \'hours\', interval_number = 2, nextcall = current_timestamp + interval \'1 hour\' where model = \'sync.client.entity\' and function = \'sync_threaded\';',
-              db)
-    if rc != 0:
-        return rc
-
-    rc = psql(args,
-              'update sync_client_sync_server_connection SET host = \'127.0.0.1\', database = \'%s\';' % ss,
-              db)
-
-    return rc
-
-def activate_silentupgrade(args, db):
-    rc = psql(args, 'update sync_client_sync_server_connection set automatic_patching = \'t\';', db)
-
-    if not args.autosync:
-        ufload.progress("*** WARNING: Silent upgrade is enabled, but auto sync is not.")
-
-    return rc
+        plan.add('inactive users', "update res_users set active = 'f' where login not in ('synch', %(login)s)", False, login=adminuser)
+
+    return plan
+
+# Sync every 2 hours from now + 1 hour, with the local sync server ss
+def autosync_steps(plan, ss):
+    plan.add('enable sync cron', "update ir_cron set active = 't', interval_type = 'hours', interval_number = 2, nextcall = current_timestamp + interval '1 hour' where model = 'sync.client.entity' and function = 'sync_threaded'")
+    plan.add('auto sync server', "update sync_client_sync_server_connection SET host = '127.0.0.1', database = %(db)s", db=ss)
+
+def silentupgrade_steps(plan):
+    plan.add('silent upgrade', "update sync_client_sync_server_connection set automatic_patching = 't'")
+
+# Calls fn(db) for each of dbs, args.db_workers databases at a time.
+# Returns { db: result of fn }, the result being the exception raised
+# by fn if it failed.
+def _each(args, dbs, fn, workers=None):
+    if workers is None:
+        workers = getattr(args, 'db_workers', None) or 8
+    q = Queue.Queue()
+    for db in dbs:
+        q.put(db)
+    results = {}
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                db = q.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                res = fn(db)
+            except Exception as e:
+                res = e
+            with lock:
+                results[db] = res
+
+    threads = [ threading.Thread(target=worker, name='ufload-db-%d' % x) for x in range(max(1, min(workers, len(dbs)))) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+# Runs plan on each of dbs, args.db_workers databases at a time. plan
+# is a Plan, or a function returning the Plan of a database. Logs a
+# summary and returns { db: (rc, label of the failed step, error) }.
+def fanout(args, plan, dbs, workers=None):
+    def run(db):
+        return run_plan(args, plan if isinstance(plan, Plan) else plan(db), db)
+    results = _each(args, dbs, run, workers)
+    for db, res in results.items():
+        if isinstance(res, Exception):
+            results[db] = (1, None, str(res))
+
+    failed = sorted(db for db in results if results[db][0] != 0)
+    ufload.progress("%d of %d databases updated" % (len(results) - len(failed), len(dbs)))
+    for db in failed:
+        rc, label, error = results[db]
+        ufload.progress("Failed on %s, step '%s': %s" % (db, label, error))
+    return results
 
 
 def _checkrc(rc):
@@ -570,6 +949,29 @@ def ver(args):
     v = _run_out(args, mkpsql(args, 'show server_version'))
     return v
 
+# Quotes s as a SQL string literal
+def _literal(s):
+    return "'%s'" % s.replace("'", "''")
+
+# The pg_stat_activity column of the backend pid: procpid before
+# Postgres 9.2. Asked to the server once per run.
+_pidcols = {}
+
+def _pid_column(args):
+    k = (args.db_host, args.db_port)
+    if k not in _pidcols:
+        v = filter(len, map(lambda x: x.strip(), _run_out(args, mkpsql(args, 'show server_version_num'))))
+        try:
+            num = int(v[0])
+        except (IndexError, ValueError):
+            num = 90200
+        _pidcols[k] = 'pid' if num >= 90200 else 'procpid'
+    return _pidcols[k]
+
+# Terminates the connections to the database db, or to each database of
+# the list db, and waits (at most killwait seconds) for them to be gone.
+killwait = 30
+
 def killCons(args, db):
     # A wacky exception for UF5: we are not superuser on Postgres, so we
     # cannot kill connections. So bounce OpenERP instead.
@@ -577,24 +979,36 @@ def killCons(args, db):
         _run(args, [ 'sh', '-c', args.killconn])
         return
 
+    dbs = [ db ] if isinstance(db, basestring) else list(db)
+    if not dbs:
+        return
+
+    # Our own connections to them go first
+    for d in dbs:
+        pg.close(args, d)
+
     # First, revoke CONNECT rights to the DB so there won't be any auto-connect issues
-    psql(args, 'REVOKE CONNECT ON DATABASE %s FROM public' % db, 'postgres', True)
+    psql(args, 'REVOKE CONNECT ON DATABASE %s FROM public' % ', '.join('"%s"' % d for d in dbs), 'postgres', True)
 
-    # For Postgres 8, it is procpid, for 9 it is pid
-    v = ver(args)
-    if len(v) > 1 and ' 9.' in v[0]:
-        col = 'pid'
-    else:
-        col = 'procpid'
+    col = _pid_column(args)
+    where = "datname in (%s) and %s <> pg_backend_pid()" % (', '.join(_literal(d) for d in dbs), col)
+    psql(args, 'select pg_terminate_backend(%s) from pg_stat_activity where %s' % (col, where), 'postgres', True)
+    if args.show:
+        return
 
-    cmd = mkpsql(args, 'select %s from pg_stat_activity where datname = \'%s\';' % (col, db), 'postgres')
-    for i in _run_out(args, cmd):
-        try:
-            pid = int(i)
-            psql(args, 'select pg_terminate_backend(%s)' % pid, 'postgres', True)
-        except ValueError:
-            # skip lines which are not numbers
-            pass
+    # pg_terminate_backend only sends a signal: wait for the backends
+    # to exit, or the DROP which follows fails. Without psycopg2 each
+    # look is a psql process, so they get further apart.
+    cmd = mkpsql(args, 'select count(*) from pg_stat_activity where %s' % where)
+    deadline = time.time() + killwait
+    pause = 0.1
+    while time.time() < deadline:
+        v = filter(len, map(lambda x: x.strip(), _run_out(args, cmd)))
+        if not v or v[0] == '0':
+            return
+        time.sleep(pause)
+        pause = min(pause * 2, 1)
+    ufload.progress("Connections to %s are still open after %d seconds" % (', '.join(dbs), killwait))
 
 def get_hwid(args):
     if sys.platform == 'win32':
@@ -633,28 +1047,53 @@ def _db_to_instance(args, db):
 
     return '_'.join(db.split('_')[0:-2])
 
+# Drops the databases dbs, args.db_workers at a time, once all their
+# connections are gone. Logs the space given back by each of them and
+# returns the list of the databases which could not be dropped.
+def dropDbs(args, dbs):
+    if not dbs:
+        return []
+    sizes = dict(catalog(args))
+    killCons(args, dbs)
+
+    def drop(d):
+        ufload.progress("Dropping database %s" % d)
+        return psql(args, 'DROP DATABASE IF EXISTS \"%s\"' % d)
+    results = _each(args, dbs, drop)
+
+    failed = []
+    total = 0
+    for d in dbs:
+        rc = results.get(d)
+        if rc != 0:
+            ufload.progress("Error: unable to drop database %s: %s" % (d, rc))
+            failed.append(d)
+            continue
+        e = sizes.get(d)
+        if e is not None and e.size is not None:
+            total += e.size
+            ufload.progress("Dropped %s: %d Mb reclaimed" % (d, e.size / (1024 * 1024)))
+        else:
+            ufload.progress("Dropped %s" % d)
+    ufload.progress("%d of %d databases dropped, %d Mb reclaimed" % (len(dbs) - len(failed), len(dbs), total / (1024 * 1024)))
+    return failed
+
 def cleanDbs(args):
 
     import re
     p = re.compile('^[A-Z0-9_]{5,}_[0-9]{8}_[0-9]{4}$')
     ps = re.compile('SYNC')
 
-    nb = 0
+    victims = []
     for d in _allDbs(args):
 
         m = p.match(d)
         ms = ps.search(d)
 
         if m == None and ms == None and d != '':
-            ufload.progress("Dropping database %s" % d)
-            killCons(args, d)
-            rc = psql(args, 'DROP DATABASE IF EXISTS \"%s\"'%d)
-            if rc != 0:
-                ufload.progress("Error: unable to drop database %s" % d)
-            else:
-                nb = nb + 1
+            victims.append(d)
 
-    return nb
+    return len(victims) - len(dropDbs(args, victims))
 
 # Remove all databases which come from the same instance as db
 def clean(args, db):
@@ -665,29 +1104,84 @@ def clean(args, db):
     toClean[i] = True
     toKeep[db] = True
 
+    victims = []
     for d in _allDbs(args):
         i = _db_to_instance(args, d)
         #if not args.db_prefix and i and d not in toKeep and i in toClean:
         if i and d not in toKeep and i in toClean:
             ufload.progress("Cleaning other database for instance %s: %s" % (i, d))
-            killCons(args, d)
-            rc = psql(args, 'DROP DATABASE IF EXISTS \"%s\"'%d)
-            if rc != 0:
-                return rc
+            victims.append(d)
+
+    if dropDbs(args, victims):
+        return 1
     return 0            
 
+# Snapshot of pg_database, read once per run (per server) and kept up to
+# date by the CREATE, DROP and RENAME run through psql(). Each database
+# has its owner, its size (None when we cannot connect to it) and its
+# creation time (None unless we may read the server files).
+CatalogEntry = collections.namedtuple('CatalogEntry', 'owner size created template')
+
+_catalogs = {}
+_catalog_lock = threading.Lock()
+
+_createDb = re.compile(r'^\s*CREATE\s+DATABASE\s+"?([^"\s;]+)"?', re.I)
+_dropDb = re.compile(r'^\s*DROP\s+DATABASE\s+(?:IF\s+EXISTS\s+)?"?([^"\s;]+)"?', re.I)
+_renameDb = re.compile(r'^\s*ALTER\s+DATABASE\s+"?([^"\s;]+)"?\s+RENAME\s+TO\s+"?([^"\s;]+)"?', re.I)
+
+def _catalog_key(args):
+    return (args.db_host, args.db_port)
+
+def _split(line):
+    return [ x.strip() for x in line.split('|') ]
+
+def catalog(args, refresh=False):
+    k = _catalog_key(args)
+    with _catalog_lock:
+        if not refresh and k in _catalogs:
+            return _catalogs[k]
+
+    dbs = {}
+    for line in _run_out(args, mkpsql(args, "select datname, pg_get_userbyid(datdba), case when has_database_privilege(datname, 'CONNECT') then pg_database_size(datname) end, datistemplate from pg_database")):
+        v = _split(line)
+        if len(v) != 4 or not v[0]:
+            continue
+        size = int(v[2]) if v[2] else None
+        dbs[v[0]] = CatalogEntry(v[1], size, None, v[3] == 't')
+    if not dbs:
+        # the query failed (there are always templates): ask again next time
+        return dbs
+    for line in _run_out(args, mkpsql(args, "select datname, (pg_stat_file('base/' || oid || '/PG_VERSION')).modification from pg_database")):
+        v = _split(line)
+        if len(v) == 2 and v[0] in dbs:
+            dbs[v[0]] = dbs[v[0]]._replace(created=v[1])
+
+    with _catalog_lock:
+        _catalogs[k] = dbs
+    return dbs
+
+def _catalog_update(args, sql):
+    with _catalog_lock:
+        dbs = _catalogs.get(_catalog_key(args))
+        if dbs is None:
+            return
+        m = _createDb.match(sql)
+        if m:
+            dbs[m.group(1)] = CatalogEntry(args.db_user, 0, time.strftime('%Y-%m-%d %H:%M:%S'), False)
+        m = _dropDb.match(sql)
+        if m:
+            dbs.pop(m.group(1), None)
+        m = _renameDb.match(sql)
+        if m and m.group(1) in dbs:
+            dbs[m.group(2)] = dbs.pop(m.group(1))
+
 def _allDbs(args):
-    if args.db_user:
-        v = _run_out(args, mkpsql(args, 'select datname from pg_database where datdba=(select usesysid from pg_user where usename=\'%s\') and datistemplate = false and datname != \'postgres\'' % args.db_user))
-    else:
-        v = _run_out(args, mkpsql(args, 'select datname from pg_database where datistemplate = false and datname != \'postgres\''))
-        
-    return filter(len, map(lambda x: x.strip(), v))
+    dbs = catalog(args)
+    return sorted(d for d, e in dbs.items()
+                  if not e.template and d != 'postgres' and (not args.db_user or e.owner == args.db_user))
 
 def exists(args, db):
-    v = _run_out(args, mkpsql(args, 'select datname from pg_database where datname = \'%s\'' % db))
-    v = filter(len, map(lambda x: x.strip(), v))
-    return len(v)==1 and v[0] == db
+    return db in catalog(args)
 
 # These two functions read and write from a little "about" table
 # where we store the size of the input file, which helps us avoid
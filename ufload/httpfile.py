@@ -1,18 +1,71 @@
 # http://stackoverflow.com/questions/7829311/is-there-a-library-for-retrieving-a-file-from-a-remote-zip/7852229
 
+import collections
+
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# A requests session keeping up to pool_size connections alive per host.
+# Idempotent requests failing on connection errors or on 502/503/504
+# are retried by the adapter, with a backoff.
+def make_session(pool_size=10, retries=3):
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=Retry(total=retries, backoff_factor=1,
+                                            status_forcelist=(502, 503, 504),
+                                            raise_on_status=False))
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s
 
+# A read-only, seekable file object on a remote file. Reads go through
+# a cache of aligned blocks: the missing blocks are fetched with one Range
+# request per run of adjacent blocks, and a sequential read also fetches
+# the next readahead blocks. Authentication is either a user and password
+# (basic auth) or ready-made headers (cookies), and the size can be given
+# when it is already known. When the server refuses the headers, reauth()
+# is called once for new ones.
 class HttpFile(object):
-    def __init__(self, url, user, pw):
+    block_size = 64 * 1024
+    cache_blocks = 256
+    readahead = 16
+
+    def __init__(self, url, user=None, pw=None, session=None, headers=None, size=-1,
+                 block_size=None, cache_blocks=None, reauth=None):
         self.url = url
+        self.reauth = reauth
         self.user = user
         self.pw = pw
+        self.session = session or make_session()
+        self.headers = headers or {}
         self.offset = 0
-        self._size = -1
+        self._size = size
+        if block_size is not None:
+            self.block_size = block_size
+        if cache_blocks is not None:
+            self.cache_blocks = cache_blocks
+        self.blocks = collections.OrderedDict()
+        self.requests = 0
+        self._next = None
+
+    def _auth(self):
+        if self.user is None:
+            return None
+        return (self.user, self.pw)
+
+    # Sends the request with the headers, new ones if they are refused
+    def _send(self, send, extra={}):
+        r = send(dict(self.headers, **extra))
+        if r.status_code in (401, 403) and self.reauth is not None:
+            self.headers = self.reauth()
+            self.reauth = None
+            r = send(dict(self.headers, **extra))
+        return r
 
     def size(self):
         if self._size < 0:
-            r = requests.head(self.url, auth=(self.user, self.pw))
+            r = self._send(lambda h: self.session.head(self.url, auth=self._auth(), headers=h))
             if not r.ok:
                 raise RuntimeError("status code " + str(r.status_code))
             if "content-length" in r.headers:
@@ -23,19 +76,58 @@ class HttpFile(object):
                 self._size = 0
         return self._size
 
-    def read(self, count=-1):
-        if count < 0:
-            count = self.size() - self.offset
-        end = self.offset + count - 1
-        h = { 'Range': "bytes=%s-%s" % (self.offset, end) }
-        r = requests.get(self.url, auth=(self.user, self.pw), headers=h)
+    def _fetch(self, start, end):
+        self.requests += 1
+        r = self._send(lambda h: self.session.get(self.url, auth=self._auth(), headers=h),
+                       { 'Range': "bytes=%s-%s" % (start, end) })
         if not r.ok:
             raise RuntimeError("status code " + str(r.status_code))
+        count = end - start + 1
         if len(r.content) < count:
             raise RuntimeError("wanted %d bytes, got %d bytes" % (count, len(r.content)))
-        self.offset += count
         return r.content[0:count]
 
+    # Fetches the missing blocks among first..last, adjacent ones together
+    def _load(self, first, last):
+        bs = self.block_size
+        run = []
+        for b in range(first, last + 2):
+            if b <= last and b not in self.blocks:
+                run.append(b)
+                continue
+            if run:
+                data = self._fetch(run[0] * bs, min((run[-1] + 1) * bs, self.size()) - 1)
+                for n in run:
+                    self.blocks[n] = data[(n - run[0]) * bs:(n - run[0] + 1) * bs]
+                run = []
+
+    def read(self, count=-1):
+        if count < 0 or self.offset + count > self.size():
+            count = max(0, self.size() - self.offset)
+        if count == 0:
+            return ''
+
+        bs = self.block_size
+        first = self.offset / bs
+        last = (self.offset + count - 1) / bs
+        ahead = last
+        if self.offset == self._next:
+            ahead = min(last + self.readahead, (self.size() - 1) / bs)
+        self._load(first, ahead)
+
+        data = []
+        for b in range(first, last + 1):
+            block = self.blocks.pop(b)
+            self.blocks[b] = block
+            data.append(block)
+        while len(self.blocks) > max(self.cache_blocks, ahead - first + 1):
+            self.blocks.popitem(last=False)
+
+        start = self.offset - first * bs
+        self.offset += count
+        self._next = self.offset
+        return ''.join(data)[start:start + count]
+
     def seek(self, offset, whence=0):
         if whence == 0:
             self.offset = offset
@@ -0,0 +1,138 @@
+# Local index of the OneDrive backup folders, kept in SQLite.
+#
+# Each folder is listed completely once every full_refresh seconds. In
+# between, only the files modified since the newest one we know about are
+# asked for, so listing a folder is a local query plus one small request.
+# Files deleted from the cloud are only noticed by the complete listing.
+
+import logging
+import sqlite3
+import time
+
+import ufload
+import webdav
+
+def _instance(name):
+    return '-'.join(name.split('-')[:-1])
+
+class Index(object):
+    full_refresh = 24 * 3600
+
+    def __init__(self, path):
+        self.path = path
+        c = self._db()
+        try:
+            with c:
+                c.execute('''create table if not exists files (
+                    folder text not null,
+                    name text not null,
+                    instance text not null,
+                    modified text not null,
+                    size integer not null,
+                    url text not null,
+                    primary key (folder, name))''')
+                c.execute('create index if not exists files_latest on files (folder, instance, modified)')
+                c.execute('''create table if not exists folders (
+                    folder text primary key,
+                    last_modified text,
+                    last_full real not null)''')
+        finally:
+            c.close()
+
+    # One connection per call: the index can be used from several threads
+    def _db(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    # An incremental refresh does not see the files deleted from the
+    # folder: full forces a complete listing. With patterns (the -i
+    # arguments), a complete listing only asks for the matching names,
+    # and the folder is not marked as completely listed.
+    def refresh(self, dav, d, patterns=None, full=False):
+        folder = dav.baseurl + d
+        c = self._db()
+        try:
+            row = c.execute('select last_modified, last_full from folders where folder = ?', (folder,)).fetchone()
+            full = full or row is None or time.time() - row[1] > self.full_refresh
+            if full and patterns:
+                files = dav.list(d, patterns)
+            elif full:
+                files = dav.list(d)
+            else:
+                files = dav.list(d, since=row[0])
+
+            with c:
+                if full and not patterns:
+                    c.execute('delete from files where folder = ?', (folder,))
+                c.executemany('insert or replace into files values (?, ?, ?, ?, ?, ?)',
+                              [ (folder, f.name, _instance(f.name), f.modified, f.size, f.url) for f in files ])
+                last = c.execute('select max(modified) from files where folder = ?', (folder,)).fetchone()[0]
+                if full and not patterns:
+                    c.execute('insert or replace into folders values (?, ?, ?)', (folder, last, time.time()))
+                elif not full:
+                    c.execute('update folders set last_modified = ? where folder = ?', (last, folder))
+            return len(files)
+        finally:
+            c.close()
+
+    # Refreshes the folder from the cloud. If the cloud cannot be reached,
+    # what the index knows is used, unless full is set: then the complete
+    # listing is required.
+    def _refresh(self, dav, d, patterns=None, full=False):
+        try:
+            n = self.refresh(dav, d, patterns, full)
+            ufload.progress('Index of %s refreshed (%d new or changed files)' % (d, n))
+        except Exception as e:
+            if full:
+                raise
+            ufload.progress('Unable to refresh the index of %s, using the local copy: %s' % (d, e))
+            logging.warn('Index of %s not refreshed, the listing may miss new files or show deleted ones: %s' % (d, e))
+
+    # Returns the files of the folder, newest first, refreshed first
+    def list(self, dav, d, full=False):
+        self._refresh(dav, d, full=full)
+        c = self._db()
+        try:
+            rows = c.execute('select name, modified, size, url from files where folder = ? order by modified desc',
+                             (dav.baseurl + d,)).fetchall()
+        finally:
+            c.close()
+        return [ webdav.CloudFile(*r) for r in rows ]
+
+    # Returns { instance: [ CloudFile, newest first ] } for the zips of the
+    # folder modified before the before timestamp, refreshed first. Only the
+    # instances containing one of the patterns are kept, and only their
+    # newest zip with latest. Both are answered by the files_latest index.
+    def instances(self, dav, d, patterns=None, before=None, latest=False):
+        self._refresh(dav, d, patterns)
+
+        where = "folder = ? and instance != '' and name like '%.zip' and modified < ?"
+        params = [ dav.baseurl + d, before or '9999' ]
+        subs = []
+        for pat in patterns or []:
+            for p in pat.split(','):
+                if p:
+                    subs.append("instance like ? escape '\\'")
+                    params.append('%%%s%%' % p.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+        if subs:
+            where += ' and (%s)' % ' or '.join(subs)
+
+        if latest:
+            sql = """select f.instance, f.name, f.modified, f.size, f.url
+                     from files f join (select instance, max(modified) m from files where %s group by instance) l
+                     on f.folder = ? and f.instance = l.instance and f.modified = l.m
+                     where f.name like '%%.zip'
+                     order by f.instance""" % where
+            params.append(params[0])
+        else:
+            sql = """select instance, name, modified, size, url from files where %s
+                     order by instance, modified desc""" % where
+
+        c = self._db()
+        try:
+            rows = c.execute(sql, params).fetchall()
+        finally:
+            c.close()
+        ret = {}
+        for r in rows:
+            ret.setdefault(r[0], []).append(webdav.CloudFile(*r[1:]))
+        return ret
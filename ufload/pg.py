@@ -0,0 +1,187 @@
+# Persistent connections to Postgres. When psycopg2 is installed, the
+# statements of ufload.db are run on connections kept open for the
+# whole run, at most one idle connection per database, instead of
+# starting a psql process (and a new Postgres backend) for each one.
+
+import atexit
+import collections
+import re
+import sys
+import threading
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+_lock = threading.Lock()
+_idle = collections.defaultdict(list)
+
+# Statements which need nobody to be connected to a database
+_exclusive = re.compile(r'\b(?:(?:DROP|ALTER)\s+DATABASE(?:\s+IF\s+EXISTS)?|TEMPLATE)\s+"?([^"\s;]+)"?', re.I)
+
+def available():
+    return psycopg2 is not None
+
+def _key(args, db):
+    return (args.db_host, args.db_port, args.db_user, db)
+
+# Values are kept as the text sent by Postgres, like psql shows them
+def _text(value, cur):
+    return value
+
+def _connect(args, db):
+    kw = { 'dbname': db }
+    if args.db_host is not None:
+        kw['host'] = args.db_host
+    if args.db_port is not None:
+        kw['port'] = args.db_port
+    if args.db_user is not None:
+        kw['user'] = args.db_user
+    if args.db_pw is not None:
+        kw['password'] = args.db_pw
+    # otherwise libpq reads PGPASSWORD or .pgpass, as psql does
+    conn = psycopg2.connect(**kw)
+    conn.autocommit = True
+    ext = psycopg2.extensions
+    for t in (ext.INTEGER, ext.LONGINTEGER, ext.FLOAT, ext.DECIMAL, ext.BOOLEAN,
+              ext.DATE, ext.TIME, ext.DATETIME, ext.INTERVAL, ext.UNICODE):
+        ext.register_type(ext.new_type(t.values, 'UFLOAD_' + t.name, _text), conn)
+    return conn
+
+def _get(args, db):
+    with _lock:
+        conns = _idle.get(_key(args, db))
+        if conns:
+            return conns.pop()
+    return _connect(args, db)
+
+def _put(args, db, conn):
+    if conn.closed:
+        return
+    with _lock:
+        conns = _idle[_key(args, db)]
+        if not conns:
+            conns.append(conn)
+            return
+    conn.close()
+
+# Closes the idle connections to db (all databases when db is None)
+def close(args=None, db=None):
+    with _lock:
+        if db is None:
+            keys = _idle.keys()
+        else:
+            keys = [ _key(args, db) ]
+        conns = []
+        for k in keys:
+            conns.extend(_idle.pop(k, []))
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+atexit.register(close)
+
+# Formats the rows like psql -q -t (aligned, no header)
+def _format(rows):
+    if not rows:
+        return ''
+    rows = [ [ '' if v is None else str(v) for v in row ] for row in rows ]
+    widths = [ max(len(row[i]) for row in rows) for i in range(len(rows[0])) ]
+    out = []
+    for row in rows:
+        cells = [ v.ljust(w) for v, w in zip(row[:-1], widths) ] + [ row[-1] ]
+        out.append(' ' + ' | '.join(cells))
+    return '\n'.join(out) + '\n\n'
+
+# Runs sql on db, returning (rc, output) as psql -q -t -c would: rc is
+# 1 when the statement failed, 2 when the connection failed, and the
+# output has the notices and the error message after the rows.
+def execute(args, sql, db='postgres'):
+    for target in _exclusive.findall(sql):
+        close(args, target)
+
+    for attempt in (1, 2):
+        try:
+            conn = _get(args, db)
+        except psycopg2.Error as e:
+            return 2, 'psql: %s' % str(e).strip()
+
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute(sql)
+                rows = cur.fetchall() if cur.description else []
+            finally:
+                cur.close()
+        except psycopg2.Error as e:
+            if conn.closed and attempt == 1:
+                # the backend went away (killCons, restart): once more
+                continue
+            out = ''.join(conn.notices) + (e.pgerror or str(e))
+            del conn.notices[:]
+            _put(args, db, conn)
+            return 1, out
+
+        out = ''.join(conn.notices) + _format(rows)
+        del conn.notices[:]
+        _put(args, db, conn)
+        return 0, out
+
+# Same as execute, writing the output as psql would
+def run(args, sql, db='postgres'):
+    rc, out = execute(args, sql, db)
+    if rc != 0:
+        sys.stderr.write(out.rstrip('\n') + '\n')
+    elif out:
+        sys.stdout.write(out)
+    return rc
+
+# Runs steps, a list of (label, sql, required), as one transaction on
+# db with params bound by psycopg2. A step which is not required runs
+# in a savepoint, so that its failure only undoes itself. Returns (rc,
+# label of the step which failed, error message).
+def execute_plan(args, steps, params, db='postgres'):
+    for attempt in (1, 2):
+        try:
+            conn = _get(args, db)
+        except psycopg2.Error as e:
+            return 2, 'connect', str(e).strip()
+
+        label = None
+        try:
+            conn.autocommit = False
+            cur = conn.cursor()
+            try:
+                for label, sql, required in steps:
+                    if required:
+                        cur.execute(sql, params)
+                        continue
+                    cur.execute('SAVEPOINT ufload_step')
+                    try:
+                        cur.execute(sql, params)
+                    except psycopg2.Error:
+                        cur.execute('ROLLBACK TO SAVEPOINT ufload_step')
+                    else:
+                        cur.execute('RELEASE SAVEPOINT ufload_step')
+                label = 'commit'
+                conn.commit()
+            finally:
+                cur.close()
+        except psycopg2.Error as e:
+            if conn.closed:
+                if attempt == 1 and (label is None or label == steps[0][0]):
+                    # the backend went away before the plan started
+                    continue
+                return 1, label, e.pgerror or str(e)
+            conn.rollback()
+            conn.autocommit = True
+            _put(args, db, conn)
+            return 1, label, e.pgerror or str(e)
+
+        conn.autocommit = True
+        _put(args, db, conn)
+        return 0, None, None
@@ -6,3 +6,147 @@ def test_match():
     m = map(lambda x : ufload.cloud._match_any_wildcard(wild, x), x)
     assert(m == [ False, True, True ])
 
+def test_prefetcher(tmpdir):
+    def fetch(key, job):
+        fn = str(tmpdir.join(job))
+        with open(fn, 'wb') as f:
+            f.write('x' * 10)
+        return fn
+    p = ufload.cloud.Prefetcher(fetch, [ ('a', 'a.zip'), ('b', 'b.zip'), ('c', 'c.zip') ], depth=1).start()
+    assert(p.get('a').endswith('a.zip'))
+    assert(p.get('b').endswith('b.zip'))
+    p.close()
+    assert(p.ready == {})
+
+def test_backup_cache(tmpdir):
+    import os, zipfile
+    import ufload.cache
+    src = str(tmpdir.join('OCG_HQ-Mon.zip'))
+    z = zipfile.ZipFile(src, 'w')
+    z.writestr('OCG_HQ-20200106-010000-A-UF.dump', 'x' * 100)
+    z.close()
+    sz = os.path.getsize(src)
+
+    c = ufload.cache.BackupCache(str(tmpdir.join('cache')), sz)
+    k = ufload.cache.key('/a/OCG_HQ-Mon.zip', '2020-01-06T01:00:00Z', sz)
+    assert(not c.get(k, sz, str(tmpdir.join('out.zip'))))
+    c.put(k, src)
+    assert(c.get(k, sz, str(tmpdir.join('out.zip'))))
+    assert(not c.get(k, sz + 1, str(tmpdir.join('out.zip'))))
+
+    # over budget: the oldest entry goes away
+    c.put(k, src)
+    os.utime(c._file(k), (0, 0))
+    src2 = str(tmpdir.join('OCG_HQ-Tue.zip'))
+    with open(src, 'rb') as f:
+        with open(src2, 'wb') as f2:
+            f2.write(f.read())
+    k2 = ufload.cache.key('/a/OCG_HQ-Tue.zip', '2020-01-07T01:00:00Z', sz)
+    c.put(k2, src2)
+    assert(os.listdir(c.path) == [ k2 + '.zip' ])
+
+    # found damaged by the restore
+    c.drop(k2)
+    assert(os.listdir(c.path) == [])
+    assert(not c.get(k2, sz, str(tmpdir.join('out.zip'))))
+
+
+class _Response(object):
+    def __init__(self, data, n, fail=False):
+        self.data, self.n, self.fail = data, n, fail
+    def iter_content(self, chunk_size=1):
+        for x in range(0, len(self.data), self.n):
+            yield self.data[x:x + self.n]
+        if self.fail:
+            raise IOError('connection reset')
+    def close(self):
+        self.closed = True
+
+def test_zip_stream():
+    import os, io, zipfile
+    dump = os.urandom(50000) + 'x' * 50000
+    for method in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+        buf = io.BytesIO()
+        z = zipfile.ZipFile(buf, 'w', method)
+        z.writestr('OCG_HQ-20200106-010000-A-UF.dump', dump)
+        z.close()
+
+        zs = ufload.cloud.ZipStream(_Response(buf.getvalue(), 1000), chunk_size=4096, depth=2).start()
+        assert(zs.name == 'OCG_HQ-20200106-010000-A-UF.dump')
+        assert(zs.size == len(dump))
+        out = ''.join(iter(lambda: zs.read(8192), ''))
+        zs.close()
+        assert(out == dump)
+        assert(zs.error is None)
+
+        # the connection drops half-way
+        zs = ufload.cloud.ZipStream(_Response(buf.getvalue()[:60000], 1000, True), depth=2).start()
+        try:
+            while zs.read(8192):
+                pass
+            assert(False)
+        except IOError:
+            pass
+        zs.close()
+        assert(isinstance(zs.error, IOError))
+
+def test_zip_stream_unsupported():
+    import os, io, struct, zipfile
+    buf = io.BytesIO()
+    z = zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED)
+    z.writestr('OCG_HQ-20200106-010000-A-UF.dump', os.urandom(100000))
+    z.close()
+    # an unknown compression method in the local header
+    data = buf.getvalue()
+    data = data[:8] + struct.pack('<H', 12) + data[10:]
+
+    r = _Response(data, 100)
+    zs = ufload.cloud.ZipStream(r, depth=2)
+    try:
+        zs.start()
+        ok = False
+    except zipfile.BadZipfile:
+        ok = True
+    assert(ok)
+    # the connection goes back and the reader does not wait on a full queue
+    assert(getattr(r, 'closed', False))
+    assert(not [ t for t in zs.threads if t.is_alive() ])
+
+def test_dump_zip(tmpdir):
+    import os, zipfile, zlib
+    dump = os.urandom(300000)
+    src = str(tmpdir.join('OCG_HQ-Mon.zip'))
+    z = zipfile.ZipFile(src, 'w', zipfile.ZIP_DEFLATED)
+    z.writestr('OCG_HQ-20200106-010000-A-UF.dump', dump)
+    z.close()
+    good = open(src, 'rb').read()
+
+    dz = ufload.cloud.DumpZip(src)
+    assert(dz.name == 'OCG_HQ-20200106-010000-A-UF.dump')
+    assert(dz.size == len(dump))
+    assert(dz.member.read() == dump)
+    dz.close()
+
+    # truncated: rejected before anything is restored
+    with open(src, 'wb') as f:
+        f.write(good[:len(good) / 2] + good[-200:])
+    try:
+        ufload.cloud.DumpZip(src)
+        ok = True
+    except (zipfile.BadZipfile, IOError):
+        ok = False
+    assert(not ok)
+
+    # corrupted data: the CRC-32 check fails while reading
+    bad = bytearray(good)
+    bad[len(good) / 2] ^= 0xff
+    with open(src, 'wb') as f:
+        f.write(bad)
+    try:
+        dz = ufload.cloud.DumpZip(src)
+        while dz.member.read(8192):
+            pass
+        ok = True
+    except (zipfile.BadZipfile, zlib.error):
+        ok = False
+    assert(not ok)
@@ -20,3 +20,196 @@ def test_db_to_inst():
     i = ufload.db._db_to_instance(ArgPfx(), "prod_HQ_OCA_20161116_0102")
     assert i == "HQ_OCA"
 
+
+def test_plan():
+    p = ufload.db.Plan()
+    p.add('login', "update res_users set login = %(login)s where id = 1", login="it's")
+    p.add('logo', "update res_company set logo = %(logo)s", False, logo='x')
+    assert p.params == { 's0_login': "it's", 's1_logo': 'x' }
+    assert p.steps[0] == ('login', "update res_users set login = %(s0_login)s where id = 1", True)
+    script = p.script().split('\n')
+    assert script[1] == "update res_users set login = :'s0_login' where id = 1;"
+    assert script[2:5] == [ '\\echo ufload-step: 1', '\\set ON_ERROR_STOP off', '\\set ON_ERROR_ROLLBACK on' ]
+    # psql < 9.0: quoted in the script
+    p.add('names', "update x set a = 'b%%' where name = any(%(names)s)", names=[ 'a', 'b\\c' ])
+    script = p.script(True).split('\n')
+    assert script[1] == "update res_users set login = 'it''s' where id = 1;"
+    assert script[-2] == "update x set a = 'b%' where name = any(E'{\"a\",\"b\\\\\\\\c\"}');"
+
+class ArgShow:
+    def __init__(self):
+        self.show = True
+        self.db_workers = 2
+
+def test_fanout():
+    seen = []
+    def plan(db):
+        seen.append(db)
+        p = ufload.db.Plan()
+        p.add('touch', "update about set length = %(l)s", l=len(db))
+        return p
+    res = ufload.db.fanout(ArgShow(), plan, [ 'a', 'bb', 'ccc' ])
+    assert sorted(seen) == [ 'a', 'bb', 'ccc' ]
+    assert res == { 'a': (0, None, None), 'bb': (0, None, None), 'ccc': (0, None, None) }
+
+class ArgCat:
+    def __init__(self):
+        self.db_host = 'catalog-test'
+        self.db_port = None
+        self.db_user = 'openpg'
+
+def test_catalog_update():
+    args = ArgCat()
+    e = ufload.db.CatalogEntry('openpg', 100, None, False)
+    ufload.db._catalogs[(args.db_host, args.db_port)] = { 'OCG_HQ_20200101_0100': e, 'other': e._replace(owner='x') }
+    ufload.db._catalog_update(args, 'CREATE DATABASE "OCG_HQ_20200106_0100_42" ')
+    assert ufload.db.exists(args, 'OCG_HQ_20200106_0100_42')
+    ufload.db._catalog_update(args, 'DROP DATABASE IF EXISTS "OCG_HQ_20200101_0100"')
+    ufload.db._catalog_update(args, 'ALTER DATABASE "OCG_HQ_20200106_0100_42" RENAME TO "OCG_HQ_20200106_0100"')
+    assert ufload.db._allDbs(args) == [ 'OCG_HQ_20200106_0100' ]
+    del ufload.db._catalogs[(args.db_host, args.db_port)]
+
+def test_drop_dbs():
+    args = ArgCat()
+    args.show = True
+    args.killconn = 'true'
+    e = ufload.db.CatalogEntry('openpg', 3 * 1024 * 1024, None, False)
+    ufload.db._catalogs[(args.db_host, args.db_port)] = { 'a': e, 'b': e }
+    assert ufload.db.dropDbs(args, [ 'a', 'b' ]) == []
+    assert ufload.db._allDbs(args) == []
+    del ufload.db._catalogs[(args.db_host, args.db_port)]
+
+class ArgKill(ArgCat):
+    def __init__(self):
+        ArgCat.__init__(self)
+        self.show = True
+        self.killconn = None
+
+def test_pid_column(monkeypatch):
+    args = ArgKill()
+    monkeypatch.setattr(ufload.db, '_find_exe', lambda exe: exe)
+    for out, col in ((['  90199', ''], 'procpid'), (['  90200', ''], 'pid'), ([], 'pid')):
+        monkeypatch.setattr(ufload.db, '_pidcols', {})
+        monkeypatch.setattr(ufload.db, '_run_out', lambda args, cmd: out)
+        assert ufload.db._pid_column(args) == col
+
+def test_kill_cons(monkeypatch):
+    args = ArgKill()
+    sqls = []
+    monkeypatch.setattr(ufload.db, '_find_exe', lambda exe: exe)
+    monkeypatch.setattr(ufload.db, '_pidcols', {})
+    monkeypatch.setattr(ufload.db, 'psql', lambda args, sql, db='postgres', silent=False: sqls.append(sql) or 0)
+    monkeypatch.setattr(ufload.db, '_run_out', lambda args, cmd: [ ' 90100', '' ])
+    ufload.db.killCons(args, [ 'a', "b'c" ])
+    assert sqls == [ 'REVOKE CONNECT ON DATABASE "a", "b\'c" FROM public',
+                     "select pg_terminate_backend(procpid) from pg_stat_activity "
+                     "where datname in ('a', 'b''c') and procpid <> pg_backend_pid()" ]
+
+    # waits for the backends to be gone
+    args.show = False
+    counts = [ [ ' 2', '' ] ] * 6 + [ [ ' 0', '' ] ]
+    pauses = []
+    monkeypatch.setattr(ufload.db, '_run_out', lambda args, cmd: counts.pop(0))
+    monkeypatch.setattr(ufload.db.time, 'sleep', pauses.append)
+    ufload.db.killCons(args, 'a')
+    assert counts == []
+    # backing off up to a second between two looks
+    assert pauses == [ 0.1, 0.2, 0.4, 0.8, 1, 1 ]
+
+def test_restore_sections(monkeypatch):
+    args = ArgShow()
+    args.db_pw = None
+    args.jobs = 4
+    args.post_jobs = None
+    args.sections = True
+    ran = []
+    monkeypatch.setattr(ufload.db, '_run', lambda args, cmd, pgoptions=None: ran.append((cmd, pgoptions)) or 0)
+    assert ufload.db._restore_file(args, [ 'pg_restore', '-j', '4', '-d', 'x' ], 'x.dump') == 0
+    assert [ c for c, o in ran ] == [
+        [ 'pg_restore', '-d', 'x', '--section=pre-data', 'x.dump' ],
+        [ 'pg_restore', '-d', 'x', '--section=data', '-j', '4', 'x.dump' ],
+        [ 'pg_restore', '-d', 'x', '--section=post-data', '-j', '4', 'x.dump' ] ]
+    assert ran[1][1]['synchronous_commit'] == 'off'
+    assert '-c synchronous_commit=off' in ufload.db.pg_pass(args, ran[1][1])['PGOPTIONS']
+    assert 'maintenance_work_mem' not in ran[1][1]
+    assert ran[2][1] == { 'maintenance_work_mem': '256MB' }
+
+def test_slim_list(monkeypatch):
+    import os
+    toc = '\n'.join([ ';',
+                      '2001; 1259 16390 TABLE public ir_attachment openpg',
+                      '3001; 0 16390 TABLE DATA public ir_attachment openpg',
+                      '3002; 0 16391 TABLE DATA public res_users openpg',
+                      '3003; 0 16392 TABLE DATA public sync_client_update_received openpg' ])
+    monkeypatch.setattr(ufload.db.subprocess, 'check_output', lambda cmd, env=None: toc)
+    args = ArgShow()
+    args.db_pw = None
+    args.slim_tables = None
+    fn = ufload.db._slim_list(args, 'x.dump')
+    lines = open(fn).read().split('\n')
+    os.unlink(fn)
+    assert lines[1] == '2001; 1259 16390 TABLE public ir_attachment openpg'
+    assert lines[2] == ';3001; 0 16390 TABLE DATA public ir_attachment openpg'
+    assert lines[3] == '3002; 0 16391 TABLE DATA public res_users openpg'
+    assert lines[4].startswith(';3003;')
+
+def test_auto_jobs(monkeypatch, tmpdir):
+    fn = str(tmpdir.join('x.dump'))
+    with open(fn, 'wb') as f:
+        f.write('x' * 1000)
+    toc = [ '3001; 0 16390 TABLE DATA public ir_attachment openpg',
+            '3002; 0 16391 TABLE DATA public res_users openpg',
+            '4001; 1259 16400 INDEX public res_users_login openpg' ]
+    def run_out(args, cmd):
+        if '-l' in cmd:
+            return toc
+        if 'max_connections' in cmd[-2]:
+            return [ ' 90', '' ]
+        return []
+    monkeypatch.setattr(ufload.db, '_run_out', run_out)
+    args = ArgCat()
+    args.parallel = 1
+    ufload.db.auto_jobs_bytes = 100
+    try:
+        # 11 by size, but only 2 tables to load
+        assert ufload.db.auto_jobs(args, fn) == min(2, ufload.db.multiprocessing.cpu_count())
+    finally:
+        ufload.db.auto_jobs_bytes = 256 * 1024 * 1024
+
+def test_file_restore(tmpdir):
+    fn = str(tmpdir.join('x.dump'))
+    with open(fn, 'wb') as f:
+        f.write('x' * 100000)
+    out = str(tmpdir.join('out'))
+    args = ArgShow()
+    args.db_pw = None
+    with open(fn, 'rb') as f:
+        assert ufload.db._regular_file(f)
+        # the child reads the file itself
+        assert ufload.db._pipe_restore(args, [ 'sh', '-c', 'cat > %s' % out ], f, 100000) == 0
+    assert open(out).read() == 'x' * 100000
+    assert not ufload.db._regular_file(ufload.cloud.StatusFile(None, None))
+
+def test_dump_slim(tmpdir, monkeypatch):
+    fn = str(tmpdir.join('x.dump'))
+    with open(fn, 'wb') as f:
+        f.write('x' * 1000)
+    args = ArgShow()
+    args.db_pw = None
+    args.db_user = 'openpg'
+    args.db_tablespace = None
+    args.jobs = None
+    args.sections = False
+    args.slim = True
+    seen = []
+    def restore(args, cmd, fn, slim=False):
+        seen.append((fn, slim))
+        raise Exception('stop here')
+    monkeypatch.setattr(ufload.db, '_restore_file', restore)
+    monkeypatch.setattr(ufload.db, 'psql', lambda args, sql, db='postgres', silent=False: 0)
+    monkeypatch.setattr(ufload.db, 'killCons', lambda args, db: None)
+    monkeypatch.setattr(ufload.db, 'pg_restore', lambda args: [ 'pg_restore' ])
+    with open(fn, 'rb') as f:
+        assert ufload.db.load_dump_into(args, 'x', f, 1000) == 1
+    # -file: the dump itself is given to pg_restore, slimmed
+    assert seen == [ (fn, True) ]
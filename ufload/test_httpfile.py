@@ -0,0 +1,99 @@
+import cStringIO, zipfile
+import ufload
+import ufload.httpfile
+
+class Resp:
+    def __init__(self, content, headers={}):
+        self.content = content
+        self.headers = headers
+        self.ok = True
+        self.status_code = 206
+
+# Serves byte ranges of data, counting the requests
+class Session:
+    def __init__(self, data):
+        self.data = data
+        self.gets = 0
+
+    def head(self, url, **kw):
+        return Resp('', { 'content-length': str(len(self.data)) })
+
+    def get(self, url, headers={}, **kw):
+        self.gets += 1
+        start, end = headers['Range'].split('=')[1].split('-')
+        return Resp(self.data[int(start):int(end) + 1])
+
+def _zip(data='dump' * 10000):
+    buf = cStringIO.StringIO()
+    z = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+    z.writestr('OCG_HQ-20200106-010000-A-UF.dump', data)
+    z.close()
+    return buf.getvalue()
+
+class Dav:
+    def __init__(self, session):
+        self.session = session
+
+    def open(self, path, size=-1):
+        return ufload.httpfile.HttpFile('http://x/' + path, session=self.session, size=size)
+
+def test_peek_remote():
+    s = Session(_zip())
+    n = ufload.cloud.peek_inside_remote_file(Dav(s), 'OCG_HQ-Mon.zip')
+    assert(n == 'OCG_HQ-20200106-010000-A-UF.dump')
+
+def test_read():
+    f = ufload.httpfile.HttpFile('http://x/', session=Session('0123456789'))
+    f.seek(-3, 2)
+    assert(f.read(10) == '789')
+    assert(f.read() == '')
+
+def test_blocks():
+    import os
+    data = os.urandom(20000)
+    s = Session(_zip(data))
+    f = ufload.httpfile.HttpFile('http://x/', session=s, block_size=16, cache_blocks=10000)
+    z = zipfile.ZipFile(f)
+    assert(z.read(z.namelist()[0]) == data)
+    # the whole file is read, but most of it by read-ahead
+    assert(s.gets < len(s.data) / 16 / 8)
+    f.seek(0)
+    n = s.gets
+    f.read(100)
+    assert(s.gets == n)
+
+def test_lru():
+    s = Session('0123456789' * 100)
+    f = ufload.httpfile.HttpFile('http://x/', session=s, block_size=10, cache_blocks=3)
+    f.readahead = 0
+    # blocks 0 to 3 missing: a single request
+    assert(f.read(35) == '0123456789' * 3 + '01234')
+    assert(s.gets == 1)
+    # block 50 pushes out the least recently used ones, 0 and 1
+    f.seek(500)
+    f.read(10)
+    assert(s.gets == 2)
+    assert(f.blocks.keys() == [ 2, 3, 50 ])
+    f.seek(30)
+    f.read(5)
+    assert(s.gets == 2)
+    f.seek(0)
+    f.read(5)
+    assert(s.gets == 3)
+    # 3 was used again, so 2 went away
+    assert(f.blocks.keys() == [ 50, 3, 0 ])
+
+def test_reauth():
+    class Refusing(Session):
+        def get(self, url, headers={}, **kw):
+            if headers.get('Cookie') != 'new':
+                r = Resp('')
+                r.status_code = 403
+                r.ok = False
+                return r
+            return Session.get(self, url, headers, **kw)
+    s = Refusing('0123456789')
+    f = ufload.httpfile.HttpFile('http://x/', session=s, headers={ 'Cookie': 'old' },
+                                 reauth=lambda: { 'Cookie': 'new' })
+    assert(f.read(4) == '0123')
+    assert(f.headers == { 'Cookie': 'new' })
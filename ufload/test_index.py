@@ -0,0 +1,69 @@
+import ufload
+import ufload.index
+from ufload.webdav import CloudFile
+
+class Dav:
+    baseurl = 'https://example.org:443/personal/x/'
+
+    def __init__(self):
+        self.calls = []
+        self.files = [ CloudFile('OCG_HQ-Mon.zip', '2020-01-06T01:00:00Z', 10, '/a/OCG_HQ-Mon.zip') ]
+
+    def list(self, d, patterns=None, since=None):
+        self.calls.append(since)
+        if patterns:
+            self.calls.append(patterns)
+        return [ f for f in self.files if (since is None or f.modified >= since) and
+                 (not patterns or [ p for p in patterns if p.lower() in f.name.lower() ]) ]
+
+def test_index(tmpdir):
+    dav = Dav()
+    idx = ufload.index.Index(str(tmpdir.join('index.sqlite')))
+    assert([ f.name for f in idx.list(dav, '/Backups') ] == [ 'OCG_HQ-Mon.zip' ])
+    dav.files.append(CloudFile('OCG_HQ-Tue.zip', '2020-01-07T01:00:00Z', 20, '/a/OCG_HQ-Tue.zip'))
+    files = idx.list(dav, '/Backups')
+    assert([ f.name for f in files ] == [ 'OCG_HQ-Tue.zip', 'OCG_HQ-Mon.zip' ])
+    assert(files[0].size == 20)
+    assert(dav.calls == [ None, '2020-01-06T01:00:00Z' ])
+
+def test_index_full(tmpdir):
+    dav = Dav()
+    idx = ufload.index.Index(str(tmpdir.join('index.sqlite')))
+    idx.list(dav, '/Patches')
+    # withdrawn: only a full refresh notices it
+    dav.files = []
+    assert(len(idx.list(dav, '/Patches')) == 1)
+    assert(idx.list(dav, '/Patches', full=True) == [])
+    dav.list = None
+    try:
+        idx.list(dav, '/Patches', full=True)
+        ok = False
+    except Exception:
+        ok = True
+    assert(ok)
+
+def test_index_instances(tmpdir):
+    dav = Dav()
+    dav.files += [ CloudFile('OCG_HQ-Tue.zip', '2020-01-07T01:00:00Z', 20, '/a/OCG_HQ-Tue.zip'),
+                   CloudFile('OCB_HQ-Tue.zip', '2020-01-07T01:00:00Z', 30, '/a/OCB_HQ-Tue.zip'),
+                   CloudFile('OCB_HQ-Wed.zip', '2020-01-08T01:00:00Z', 30, '/a/OCB_HQ-Wed.zip'),
+                   CloudFile('notes.txt', '2020-01-07T01:00:00Z', 1, '/a/notes.txt') ]
+    idx = ufload.index.Index(str(tmpdir.join('index.sqlite')))
+
+    # -i: only the matching names are listed, and the folder is not
+    # taken as completely listed
+    found = idx.instances(dav, '/Backups', [ 'ocg_' ])
+    assert(dav.calls == [ None, [ 'ocg_' ] ])
+    assert(found.keys() == [ 'OCG_HQ' ])
+    found = idx.instances(dav, '/Backups', [ 'OCG_' ])
+    assert([ f.name for f in found['OCG_HQ'] ] == [ 'OCG_HQ-Tue.zip', 'OCG_HQ-Mon.zip' ])
+
+    found = idx.instances(dav, '/Backups', before='2020-01-08T00:00:00Z')
+    assert(dav.calls[-1] is None)
+    assert(sorted(found.keys()) == [ 'OCB_HQ', 'OCG_HQ' ])
+    assert([ f.name for f in found['OCB_HQ'] ] == [ 'OCB_HQ-Tue.zip' ])
+
+    found = idx.instances(dav, '/Backups', latest=True)
+    assert(dav.calls[-1] == '2020-01-08T01:00:00Z')
+    assert(dict((i, [ f.name for f in found[i] ]) for i in found) ==
+           { 'OCB_HQ': [ 'OCB_HQ-Wed.zip' ], 'OCG_HQ': [ 'OCG_HQ-Tue.zip' ] })
@@ -0,0 +1,12 @@
+import ufload.pg
+
+def test_format():
+    assert(ufload.pg._format([]) == '')
+    assert(ufload.pg._format([ ('1',) ]).split('\n') == [ ' 1', '', '' ])
+    assert(ufload.pg._format([ ('10', 'a'), ('2', None) ]) == ' 10 | a\n 2  | \n\n')
+
+def test_exclusive():
+    f = ufload.pg._exclusive.findall
+    assert(f('DROP DATABASE IF EXISTS "OCG_HQ_20200106_0100"') == [ 'OCG_HQ_20200106_0100' ])
+    assert(f('ALTER DATABASE "a_123" RENAME TO "a"') == [ 'a_123' ])
+    assert(f("select datname from pg_database where datistemplate = false") == [])
@@ -0,0 +1,293 @@
+import ufload.webdav
+
+class Resp:
+    def __init__(self, headers):
+        self.headers = headers
+
+def test_content_range():
+    r = Resp({ 'content-range': 'bytes 100-199/1000' })
+    assert(ufload.webdav._content_range(r) == (100, 1000))
+    assert(ufload.webdav._content_range(Resp({})) is None)
+    assert(ufload.webdav._content_range(Resp({ 'content-range': 'bytes */1000' })) is None)
+
+class Provider:
+    FedAuth = 'fed'
+    rtFa = 'rt'
+
+class AuthContext:
+    provider = Provider()
+
+def test_auth_cache(tmpdir):
+    import os, time
+    c = ufload.webdav.Client.__new__(ufload.webdav.Client)
+    c.baseurl = 'https://example.org:443/personal/x/'
+    c.username = 'user'
+    c.auth_cache = str(tmpdir.join('auth'))
+    c.auth_context = AuthContext()
+    c.request = type('R', (), {})()
+    c.request.context = type('C', (), {'contextWebInformation': None})()
+    c.auth_expires = time.time() + 3600
+    c.digest_expires = 0
+    c._save_auth()
+    assert(os.stat(c.auth_cache).st_mode & 0777 == 0600)
+    cached = c._load_auth()
+    assert(cached['FedAuth'] == 'fed' and cached['rtFa'] == 'rt')
+    c.forget_auth()
+    assert(c._load_auth() is None)
+
+def test_name_filter():
+    assert(ufload.webdav._name_filter(None) == '')
+    f = ufload.webdav._name_filter([ 'OCG_HQ', "SZ1,O'X" ])
+    assert(f == "substringof('OCG_HQ',Name) or substringof('SZ1',Name) or substringof('O''X',Name)")
+
+def test_clone():
+    c = ufload.webdav.Client.__new__(ufload.webdav.Client)
+    c.baseurl = 'https://example.org:443/personal/x/'
+    c.auth_context = AuthContext()
+    c.request = ufload.webdav.ClientRequest(c.auth_context)
+    c.request.context = ufload.webdav.ClientContext(c.baseurl, c.auth_context)
+    d = c.clone()
+    d.change_oc('https://example.org:443', 'OCB')
+    # dropping the digest of the clone leaves the original one alone
+    c.request.context.contextWebInformation = 'digest'
+    d.request.context.contextWebInformation = None
+    assert(c.request.context.contextWebInformation == 'digest')
+    assert(c.baseurl == 'https://example.org:443/personal/x/')
+
+class ListResp:
+    def __init__(self, status_code, files=(), next=None):
+        self.status_code = status_code
+        self.files = files
+        self.next = next
+
+    def close(self):
+        pass
+
+    def json(self):
+        d = { 'results': [ { 'Name': n, 'TimeLastModified': '2020-01-06T01:00:00Z', 'Length': '1',
+                             'ServerRelativeUrl': '/d/' + n } for n in self.files ] }
+        if self.next:
+            d['__next'] = self.next
+        return { 'd': d }
+
+# Answers the listing requests with the given responses, in turn
+class ListSession:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.urls = []
+
+    def get(self, url, **kw):
+        self.urls.append(url)
+        return self.responses.pop(0)
+
+def _list_client(session):
+    c = ufload.webdav.Client.__new__(ufload.webdav.Client)
+    c.baseurl = 'https://example.org:443/personal/x/'
+    c.session = session
+    c.logins = []
+    c.authenticate = lambda options: None
+    c.forget_auth = lambda: c.logins.append('forget')
+    c.login = lambda force=False: c.logins.append(force)
+    c.parse_error = lambda r: 'error %d' % r.status_code
+    return c
+
+def test_list_relogin():
+    s = ListSession(ListResp(403), ListResp(200, [ 'a.zip' ]))
+    c = _list_client(s)
+    assert([ f.name for f in c.list('/d') ] == [ 'a.zip' ])
+    assert(c.logins == [ 'forget', True ])
+    assert(s.urls[0] == s.urls[1])
+
+def test_list_fallback():
+    s = ListSession(ListResp(400), ListResp(200, [ 'a.zip' ]))
+    c = _list_client(s)
+    c.list('/d', patterns=[ 'OCG' ], since='2020-01-01T00:00:00Z')
+    assert('substringof' in s.urls[0] and 'substringof' not in s.urls[1])
+    assert("datetime'2020-01-01T00:00:00Z'" in s.urls[1])
+    # other errors are not hidden by a wider listing
+    c = _list_client(ListSession(ListResp(500)))
+    try:
+        c.list('/d', patterns=[ 'OCG' ])
+        ok = False
+    except Exception:
+        ok = True
+    assert(ok)
+
+def test_list_pages():
+    s = ListSession(ListResp(200, [ 'a.zip', 'b.zip' ], next='https://example.org/next'),
+                    ListResp(200, [ 'c.zip' ]))
+    c = _list_client(s)
+    assert(len(c.list('/d')) == 3)
+    # one request per page the server cuts, none of our own
+    assert('$top' not in s.urls[0] and s.urls[1] == 'https://example.org/next')
+    assert(len(s.urls) == 2)
+
+class SegResp:
+    def __init__(self, status_code, headers, body):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+# Serves data, or byte ranges of it, as a server honouring If-Range would.
+# The first answer for each start in cut stops after that many bytes,
+# extra is sent after the last byte of each range, and every answer
+# misses its last short bytes. The first deny GETs are refused.
+class SegSession:
+    def __init__(self, data, etag='"v1"', cut={}, extra='', short=0, deny=0):
+        self.deny = deny
+        self.data = data
+        self.etag = etag
+        self.cut = dict(cut)
+        self.extra = extra
+        self.short = short
+        self.ranges = []
+        self.headers = []
+
+    def head(self, url, **kw):
+        return SegResp(200, { 'content-length': str(len(self.data)), 'etag': self.etag }, '')
+
+    def get(self, url, headers={}, **kw):
+        self.headers.append(dict(headers))
+        if self.deny:
+            self.deny -= 1
+            return SegResp(403, {}, '')
+        size = len(self.data)
+        if 'Range' in headers:
+            start, end = headers['Range'].split('=')[1].split('-')
+            start, end = int(start), int(end or size - 1)
+            self.ranges.append((start, end))
+        if 'Range' not in headers or headers.get('If-Range') != self.etag:
+            status, start, end = 200, 0, size - 1
+            h = { 'content-length': str(size), 'etag': self.etag }
+        else:
+            status = 206
+            h = { 'content-range': 'bytes %d-%d/%d' % (start, end, size) }
+        body = self.data[start:end + 1]
+        if start in self.cut:
+            body = body[:self.cut.pop(start)]
+        elif end == size - 1:
+            body += self.extra
+        if self.short:
+            body = body[:-self.short]
+        return SegResp(status, h, body)
+
+class Options:
+    headers = {}
+    auth = None
+
+def _seg_client(session):
+    c = ufload.webdav.Client.__new__(ufload.webdav.Client)
+    c.session = session
+    c.segments = 4
+    c.segment_min_size = 10
+    c.buffer_size = 7
+    c.authenticate = lambda options: None
+    return c
+
+def test_download_segments(tmpdir, monkeypatch):
+    import os, requests
+    monkeypatch.setattr(ufload.webdav.time, 'sleep', lambda s: None)
+    data = os.urandom(100)
+    fn = str(tmpdir.join('x.zip'))
+
+    s = SegSession(data)
+    assert(_seg_client(s).download_segments('http://x/', Options(), fn))
+    assert(open(fn, 'rb').read() == data)
+    assert(sorted(s.ranges) == [ (0, 25), (26, 51), (52, 77), (78, 99) ])
+
+    # a range cut short goes on from where it stopped
+    s = SegSession(data, cut={ 26: 10 })
+    assert(_seg_client(s).download_segments('http://x/', Options(), fn))
+    assert(open(fn, 'rb').read() == data)
+    assert((36, 51) in s.ranges)
+
+    # too small: a single stream is used instead
+    c = _seg_client(SegSession(data))
+    c.segment_min_size = 1000
+    assert(not c.download_segments('http://x/', Options(), fn))
+
+    # changed on the server: If-Range gets the whole file, the download stops
+    s = SegSession(data)
+    s.head = lambda url, **kw: SegResp(200, { 'content-length': '100', 'etag': '"v0"' }, '')
+    try:
+        _seg_client(s).download_segments('http://x/', Options(), fn)
+        ok = False
+    except requests.exceptions.RequestException:
+        ok = True
+    assert(ok)
+
+    # more bytes than announced
+    s = SegSession(data, extra='garbage')
+    try:
+        _seg_client(s).download_segments('http://x/', Options(), fn)
+        ok = False
+    except requests.exceptions.RequestException as e:
+        ok = 'expected 100 bytes' in str(e)
+    assert(ok)
+
+def test_download_resume(tmpdir, monkeypatch):
+    import os, requests
+    monkeypatch.setattr(ufload.webdav.time, 'sleep', lambda s: None)
+    data = os.urandom(100)
+    fn = str(tmpdir.join('x.zip'))
+
+    # cut after 40 bytes: the rest is asked for with Range and If-Range
+    s = SegSession(data, cut={ 0: 40 })
+    c = _seg_client(s)
+    c.segments = 1
+    c.baseurl = 'http://x/'
+    c.login = lambda force=False: None
+    c._download('/a/x.zip', fn)
+    assert(open(fn, 'rb').read() == data)
+    assert(s.headers[1]['Range'] == 'bytes=40-' and s.headers[1]['If-Range'] == '"v1"')
+
+    # changed on the server meanwhile: If-Range gets all of it again
+    s = SegSession(data, cut={ 0: 40 })
+    get = s.get
+    def changed(url, headers={}, **kw):
+        if 'Range' in headers:
+            s.etag = '"v2"'
+        return get(url, headers, **kw)
+    s.get = changed
+    c.session = s
+    c._download('/a/x.zip', fn)
+    assert(open(fn, 'rb').read() == data)
+    assert(len(s.headers) == 2)
+
+    # always short of the announced length
+    c.session = SegSession(data, short=10)
+    try:
+        c._download('/a/x.zip', fn)
+        ok = False
+    except requests.exceptions.RequestException as e:
+        ok = 'expected 100 bytes, got' in str(e)
+    assert(ok)
+
+def test_download_relogin(tmpdir):
+    import os
+    data = os.urandom(100)
+    fn = str(tmpdir.join('x.zip'))
+    s = SegSession(data, deny=1)
+    c = _seg_client(s)
+    c.segments = 1
+    c.baseurl = 'http://x/'
+    c.logins = []
+    c.forget_auth = lambda: c.logins.append('forget')
+    c.login = lambda force=False: c.logins.append(force)
+    c._download('/a/x.zip', fn)
+    assert(open(fn, 'rb').read() == data)
+    # logged in again at once, not after a failed attempt
+    assert(c.logins == [ 'forget', True ])
@@ -1,14 +1,22 @@
 # -*- coding: utf-8 -*-
 
 import cgi
+import collections
+import copy
+import json
 import logging
 import os
+import threading
 import uuid
 
 
 import requests
+import cache as backupcache
+import httpfile
 from office365.runtime.auth.authentication_context import AuthenticationContext
+from office365.runtime.auth.saml_token_provider import SamlTokenProvider
 from office365.runtime.client_request import ClientRequest
+from office365.runtime.context_web_information import ContextWebInformation
 from office365.runtime.utilities.http_method import HttpMethod
 from office365.runtime.utilities.request_options import RequestOptions
 from office365.sharepoint.client_context import ClientContext
@@ -18,8 +26,50 @@ import time
 class ConnectionFailed(Exception):
     pass
 
+_auth_lock = threading.Lock()
+
+# One file of a folder listing
+CloudFile = collections.namedtuple('CloudFile', 'name modified size url')
+
+# OData filter keeping the names which contain one of the patterns (each
+# pattern can be a comma separated list, as for _match_instance_name)
+def _name_filter(patterns):
+    subs = []
+    for pat in patterns or []:
+        for p in pat.split(','):
+            if p:
+                subs.append("substringof('%s',Name)" % p.replace("'", "''"))
+    return ' or '.join(subs)
+
+# Returns (first byte, total length) from the Content-Range of a 206 answer
+def _content_range(r):
+    try:
+        first, total = r.headers['content-range'].split(' ', 1)[1].split('/')
+        return int(first.split('-')[0]), int(total)
+    except (KeyError, IndexError, ValueError):
+        return None
+
 class Client(object):
-    def __init__(self, host, port=0, auth=None, username=None, password=None, protocol='http', path=None):
+    # Parallel byte ranges used by download(), for files of at least segment_min_size
+    segments = 4
+    segment_min_size = 32 * 1024 * 1024
+    buffer_size = 1024 * 1024
+
+    # backupcache.BackupCache used by download(), if any
+    cache = None
+
+    # Keep-alive connections shared by all the requests of the client (and its clones)
+    pool_size = 16
+    retries = 3
+
+    # Cookies are reused from the auth cache file across runs for auth_ttl
+    # seconds, and renewed auth_margin seconds before they expire
+    auth_cache = os.path.join(os.path.expanduser('~'), '.ufload-auth')
+    auth_ttl = 4 * 3600
+    auth_margin = 300
+
+    def __init__(self, host, port=0, auth=None, username=None, password=None, protocol='http', path=None, segments=None,
+                 pool_size=None, retries=None, auth_cache=None):
         if not port:
             port = 443 if protocol == 'https' else 80
         self.path = path or ''
@@ -28,6 +78,15 @@ class Client(object):
 
         self.username = username
         self.password = password
+        if segments is not None:
+            self.segments = segments
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if retries is not None:
+            self.retries = retries
+        if auth_cache is not None:
+            self.auth_cache = auth_cache
+        self.session = httpfile.make_session(max(self.pool_size, self.segments), self.retries)
 
         # oneDrive: need to split /site/ and path
         # in our config site is /personal/UF_OCX_msf_geneva_msf_org/
@@ -35,10 +94,32 @@ class Client(object):
         self.baseurl = '{0}://{1}:{2}{3}/'.format(protocol, host, port, '/'.join(self.path.split('/')[0:3]) )
         self.login()
 
-    def login(self):
+    # Reuses the cookies (and form digest) of a previous run when the
+    # auth cache still has valid ones, unless force is set.
+    def login(self, force=False):
         ctx_auth = AuthenticationContext(self.baseurl)
 
+        cached = None
+        if not force:
+            cached = self._load_auth()
+        if cached:
+            ctx_auth.provider = SamlTokenProvider(self.baseurl, self.username, self.password)
+            ctx_auth.provider.FedAuth = cached['FedAuth']
+            ctx_auth.provider.rtFa = cached['rtFa']
+            self.auth_context = ctx_auth
+            self.request = ClientRequest(ctx_auth)
+            self.request.context = ClientContext(self.baseurl, ctx_auth)
+            self.auth_expires = cached['expires']
+            self.digest_expires = 0
+            if cached.get('digest') and cached.get('digest_expires', 0) > time.time() + self.auth_margin:
+                info = ContextWebInformation()
+                info.from_json({'FormDigestValue': cached['digest']})
+                self.request.context.contextWebInformation = info
+                self.digest_expires = cached['digest_expires']
+            return
+
         if ctx_auth.acquire_token_for_user(self.username, cgi.escape(self.password)):
+            self.auth_context = ctx_auth
             self.request = ClientRequest(ctx_auth)
             self.request.context = ClientContext(self.baseurl, ctx_auth)
 
@@ -48,6 +129,115 @@ class Client(object):
         else:
             raise ConnectionFailed(ctx_auth.get_last_error())
 
+        self.auth_expires = time.time() + self.auth_ttl
+        self.digest_expires = 0
+        self._save_auth()
+
+    # Sets the auth cookie and form digest on the request, logging in
+    # again (or asking for a new digest) shortly before they expire.
+    def authenticate(self, options):
+        now = time.time()
+        if now > self.auth_expires - self.auth_margin:
+            self.login(force=True)
+
+        context = self.request.context
+        if now > self.digest_expires - self.auth_margin:
+            context.contextWebInformation = None
+
+        new_digest = context.contextWebInformation is None
+        context.authenticate_request(options)
+        context.ensure_form_digest(options)
+        if new_digest:
+            props = getattr(context.contextWebInformation, '_properties', {})
+            self.digest_expires = now + int(props.get('FormDigestTimeoutSeconds') or 1800)
+            self._save_auth()
+
+    # The cookies were refused: forget them so the next login does the
+    # whole authentication again.
+    def forget_auth(self):
+        self.auth_expires = 0
+        self._save_auth(drop=True)
+
+    # The cookies were refused before their time (revoked, or the auth_ttl
+    # guess was too long): log in again and authenticate options anew.
+    def _relogin(self, options):
+        self.forget_auth()
+        self.login(force=True)
+        self.authenticate(options)
+
+    # Returns the response of send() once options are authenticated.
+    # When the cookies are refused, logs in again and sends it once more.
+    def _send(self, options, send):
+        self.authenticate(options)
+        r = send()
+        if r.status_code in (401, 403):
+            r.close()
+            self._relogin(options)
+            r = send()
+        return r
+
+    def _auth_key(self):
+        return '%s %s' % (self.baseurl, self.username)
+
+    def _read_auth_cache(self):
+        try:
+            with open(self.auth_cache, 'rb') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _load_auth(self):
+        if not self.auth_cache:
+            return None
+        with _auth_lock:
+            cached = self._read_auth_cache().get(self._auth_key())
+        if not cached or cached.get('expires', 0) < time.time() + self.auth_margin:
+            return None
+        return cached
+
+    def _save_auth(self, drop=False):
+        if not self.auth_cache:
+            return
+        with _auth_lock:
+            cache = self._read_auth_cache()
+            now = time.time()
+            for k in cache.keys():
+                if cache[k].get('expires', 0) < now:
+                    del cache[k]
+            if drop:
+                cache.pop(self._auth_key(), None)
+            else:
+                provider = self.auth_context.provider
+                info = self.request.context.contextWebInformation
+                cache[self._auth_key()] = {
+                    'FedAuth': provider.FedAuth,
+                    'rtFa': provider.rtFa,
+                    'expires': self.auth_expires,
+                    'digest': info.form_digest_value if info else None,
+                    'digest_expires': self.digest_expires if info else 0,
+                }
+            # The cookies are as good as the password: owner only
+            tmp = '%s.%d' % (self.auth_cache, os.getpid())
+            try:
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+                with os.fdopen(fd, 'wb') as f:
+                    json.dump(cache, f)
+                if os.path.exists(self.auth_cache):
+                    os.remove(self.auth_cache)
+                os.rename(tmp, self.auth_cache)
+            except (IOError, OSError) as e:
+                logging.getLogger('cloud.auth').warn('Unable to write the auth cache %s: %s' % (self.auth_cache, e))
+
+    def clone(self):
+        # Same cookies, but its own baseurl and its own request context:
+        # change_oc() or a new form digest on the copy does not touch the
+        # original client, which may be used by another thread meanwhile.
+        dav = copy.copy(self)
+        dav.request = ClientRequest(self.auth_context)
+        dav.request.context = ClientContext(self.baseurl, self.auth_context)
+        dav.request.context.contextWebInformation = self.request.context.contextWebInformation
+        return dav
+
     def change_oc(self, baseurl, dir):
         if dir == 'OCA':
             dir = '/personal/UF_OCA_msf_geneva_msf_org/'
@@ -66,62 +256,167 @@ class Client(object):
         options = RequestOptions(request_url)
         options.method = HttpMethod.Delete
         options.set_header("X-HTTP-Method", "DELETE")
-        self.request.context.authenticate_request(options)
-        self.request.context.ensure_form_digest(options)
-        result = requests.post(url=request_url, data="", headers=options.headers, auth=options.auth)
+        self.authenticate(options)
+        result = self.session.post(url=request_url, data="", headers=options.headers, auth=options.auth)
         if result.status_code not in (200, 201):
             raise Exception(result.content)
         return True
 
 
-    def list(self, remote_path):
-        #webUri = '%s%s' % (self.path, remote_path)
-        #request_url = "%s_api/web/getfilebyserverrelativeurl('%s')/files" % (self.baseurl, webUri)
-        request_url = "%s_api/web/getfolderbyserverrelativeurl('%s')/files" % (self.baseurl, remote_path)
+    # Lists the files of a folder, newest first. Only the properties we
+    # use are asked for. When patterns (the -i arguments) are given, the
+    # server only returns the names containing one of them, and with
+    # since (a TimeLastModified value) only the files modified at or
+    # after it.
+    # There is no $top: the files endpoint does not always give a link
+    # to the next page, which would cut the listing. The link is still
+    # followed when there is one.
+    def list(self, remote_path, patterns=None, since=None):
+        query = [ '$select=Name,TimeLastModified,Length,ServerRelativeUrl',
+                  '$orderby=TimeLastModified desc' ]
+        name_filter = _name_filter(patterns)
+        if since:
+            if name_filter:
+                name_filter = '(%s) and ' % name_filter
+            name_filter += "TimeLastModified ge datetime'%s'" % since
+        if name_filter:
+            query.append('$filter=%s' % name_filter)
+        request_url = "%s_api/web/getfolderbyserverrelativeurl('%s')/files?%s" % (self.baseurl, remote_path, '&'.join(query))
+
+        files=[]
+        while request_url:
+            options = RequestOptions(request_url)
+            options.method = HttpMethod.Get
+            options.set_header("X-HTTP-Method", "GET")
+            options.set_header('accept', 'application/json;odata=verbose')
+            result = self._send(options, lambda: self.session.get(url=request_url, headers=options.headers, auth=options.auth))
+            if result.status_code in (400, 501) and patterns and not files:
+                # substringof() not supported: filter on the date only
+                logging.getLogger('cloud.list').warn('Filtered listing refused, listing all the names: %s' % self.parse_error(result))
+                return self.list(remote_path, since=since)
+            if result.status_code != 200:
+                raise Exception(self.parse_error(result))
+
+            result = result.json()['d']
+            for item in result['results']:
+                files.append(CloudFile(item['Name'], item['TimeLastModified'],
+                                       int(item.get('Length') or 0), item['ServerRelativeUrl']))
+            request_url = result.get('__next')
+
+        return files
+
+    # Returns a read-only file object on the remote file, which only
+    # fetches the byte ranges that are read.
+    def open(self, remote_path, size=-1):
+        request_url = "%s_api/web/getfilebyserverrelativeurl('%s')/$value" % (self.baseurl, remote_path)
         options = RequestOptions(request_url)
         options.method = HttpMethod.Get
         options.set_header("X-HTTP-Method", "GET")
-        options.set_header('accept', 'application/json;odata=verbose')
-        self.request.context.authenticate_request(options)
-        self.request.context.ensure_form_digest(options)
-        result = requests.get(url=request_url, headers=options.headers, auth=options.auth)
-        #result = requests.post(url=request_url, data="", headers=options.headers, auth=options.auth)
-        result = result.json()
-        '''if result.status_code not in (200, 201):
-            print 'Error code: '
-            print result.status_code
-            raise Exception(result.content)
-            '''
-        #return True
-
-        files=[]
+        self.authenticate(options)
+        return httpfile.HttpFile(request_url, session=self.session, headers=options.headers, size=size,
+                                 reauth=lambda: self._relogin(options) or options.headers)
 
-        for i in range(len(result['d']['results'])):
-            item = result['d']['results'][i]
-            files.append(item)
+    # Returns the response of a streamed GET on the remote file: the
+    # body is read with iter_content() and the caller closes it.
+    def stream(self, remote_path):
+        request_url = "%s_api/web/getfilebyserverrelativeurl('%s')/$value" % (self.baseurl, remote_path)
+        options = RequestOptions(request_url)
+        options.method = HttpMethod.Get
+        options.set_header("X-HTTP-Method", "GET")
+        r = self._send(options, lambda: self.session.get(url=request_url, headers=options.headers, auth=options.auth,
+                                                         stream=True, timeout=120))
+        if r.status_code not in (200, 201):
+            if r.status_code in (401, 403):
+                self.forget_auth()
+            error = self.parse_error(r)
+            r.close()
+            raise requests.exceptions.RequestException(error)
+        return r
+
+    # With modified and size (TimeLastModified and Length of the listing),
+    # the backup cache is looked up first and filled afterwards.
+    def download(self, remote_path, filename, modified=None, size=None):
+        cache_key = None
+        if self.cache is not None and modified and size:
+            cache_key = backupcache.key(remote_path, modified, size)
+            if self.cache.get(cache_key, size, filename):
+                logging.getLogger('cloud.download').info('%s taken from the backup cache' % filename)
+                return filename
+
+        if cache_key is not None and os.path.exists(filename):
+            # might be a hard link to a cached backup: do not write through it
+            os.unlink(filename)
+
+        self._download(remote_path, filename)
+
+        if cache_key is not None:
+            self.cache.put(cache_key, filename)
+        return filename
 
-        return files
+    # The backup downloaded with these arguments turned out to be
+    # damaged: it must not be served from the cache again.
+    def uncache(self, remote_path, modified=None, size=None):
+        if self.cache is not None and modified and size:
+            self.cache.drop(backupcache.key(remote_path, modified, size))
 
-    def download(self, remote_path, filename):
+    def _download(self, remote_path, filename):
         request_url = "%s_api/web/getfilebyserverrelativeurl('%s')/$value" % (self.baseurl, remote_path)
         options = RequestOptions(request_url)
         options.method = HttpMethod.Get
         options.set_header("X-HTTP-Method", "GET")
         options.set_header('accept', 'application/json;odata=verbose')
+
+        if self.segments > 1:
+            try:
+                if self.download_segments(request_url, options, filename):
+                    return filename
+            except requests.exceptions.RequestException as e:
+                logging.getLogger('cloud.download').warn('Segmented download failed, using a single stream: %s' % e)
+
+        # On retry, continue from the bytes already on disk as long as the
+        # remote file still has the same validator (ETag or Last-Modified)
+        # and the same length, otherwise start again from zero.
         retry = 5
+        done = 0
+        validator = None
+        total = None
         while retry:
             try:
-                self.request.context.authenticate_request(options)
-                self.request.context.ensure_form_digest(options)
-                with requests.get(url=request_url, headers=options.headers, auth=options.auth, stream=True, timeout=120) as r:
-                    if r.status_code not in (200, 201):
+                extra = {}
+                if done and validator:
+                    extra['Range'] = 'bytes=%d-' % done
+                    extra['If-Range'] = validator
+                get = lambda: self.session.get(url=request_url, headers=dict(options.headers, **extra), auth=options.auth,
+                                               stream=True, timeout=120)
+                with self._send(options, get) as r:
+                    if r.status_code not in (200, 201, 206):
+                        if r.status_code in (401, 403):
+                            self.forget_auth()
                         error = self.parse_error(r)
                         raise requests.exceptions.RequestException(error)
 
-                    with open(filename, 'wb') as file:
-                        for chunk in r.iter_content(chunk_size=8192):
+                    if r.status_code == 206:
+                        if _content_range(r) != (done, total):
+                            done = 0
+                            raise requests.exceptions.RequestException('%s changed on the server, restarting' % remote_path)
+                        logging.getLogger('cloud.download').info('Resuming %s at byte %d' % (filename, done))
+                        mode = 'ab'
+                    else:
+                        done = 0
+                        mode = 'wb'
+                        validator = r.headers.get('etag') or r.headers.get('last-modified')
+                        total = None
+                        if 'content-length' in r.headers:
+                            total = int(r.headers['content-length'])
+
+                    with open(filename, mode, self.buffer_size) as file:
+                        for chunk in r.iter_content(chunk_size=self.buffer_size):
                             if chunk:
                                 file.write(chunk)
+                                done += len(chunk)
+
+                    if total is not None and done != total:
+                        raise requests.exceptions.RequestException('%s: expected %d bytes, got %d' % (filename, total, done))
             except requests.exceptions.RequestException:
                 time.sleep(3)
                 self.login()
@@ -134,6 +429,73 @@ class Client(object):
 
         return filename
 
+    # Fetches the file as self.segments byte ranges in parallel, each
+    # written at its offset in a preallocated file. Returns False when
+    # the file is too small to be worth it or the server does not tell
+    # its size, so the caller uses a single stream instead.
+    # A range which fails is resumed where it stopped; If-Range makes
+    # the server answer 200 instead of 206 when the file has changed,
+    # which aborts the whole download.
+    def download_segments(self, request_url, options, filename):
+        r = self._send(options, lambda: self.session.head(url=request_url, headers=options.headers, auth=options.auth,
+                                                          timeout=120, allow_redirects=True))
+        if r.status_code != 200 or 'content-length' not in r.headers:
+            return False
+        size = int(r.headers['content-length'])
+        if size < self.segment_min_size:
+            return False
+        validator = r.headers.get('etag') or r.headers.get('last-modified')
+
+        with open(filename, 'wb') as file:
+            file.truncate(size)
+
+        step = size / self.segments + 1
+        ranges = [ (start, min(start + step, size) - 1) for start in range(0, size, step) ]
+        errors = []
+
+        def fetch(start, end):
+            headers = dict(options.headers)
+            if validator:
+                headers['If-Range'] = validator
+            pos = start
+            retry = 5
+            while pos <= end and not errors:
+                headers['Range'] = 'bytes=%d-%d' % (pos, end)
+                try:
+                    with self.session.get(url=request_url, headers=headers, auth=options.auth, stream=True, timeout=120) as r:
+                        if r.status_code != 206 or _content_range(r) != (pos, size):
+                            errors.append(requests.exceptions.RequestException('range %d-%d: status code %s' % (pos, end, r.status_code)))
+                            return
+                        with open(filename, 'r+b', self.buffer_size) as file:
+                            file.seek(pos)
+                            for chunk in r.iter_content(chunk_size=self.buffer_size):
+                                if chunk:
+                                    file.write(chunk)
+                                    pos += len(chunk)
+                    if pos != end + 1:
+                        raise requests.exceptions.RequestException('range %d-%d: got %d bytes' % (start, end, pos - start))
+                except requests.exceptions.RequestException as e:
+                    retry -= 1
+                    if not retry:
+                        errors.append(e)
+                        return
+                    time.sleep(3)
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        threads = [ threading.Thread(target=fetch, args=x) for x in ranges ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise requests.exceptions.RequestException(errors[0])
+        if os.path.getsize(filename) != size:
+            raise requests.exceptions.RequestException('%s: expected %d bytes, got %d' % (filename, size, os.path.getsize(filename)))
+        return True
+
     def upload(self, fileobj, remote_path, buffer_size=None, log=False, progress_obj=False):
         iid = uuid.uuid1()
 
@@ -170,9 +532,8 @@ class Client(object):
             options = RequestOptions(request_url)
             options.method = HttpMethod.Post
 
-            self.request.context.authenticate_request(options)
-            self.request.context.ensure_form_digest(options)
-            result = requests.post(url=request_url, data=x, headers=options.headers, auth=options.auth)
+            self.authenticate(options)
+            result = self.session.post(url=request_url, data=x, headers=options.headers, auth=options.auth)
             if result.status_code not in (200, 201):
                 raise Exception(result.content)
 